@@ -0,0 +1,805 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Juan Orti Alcaine <juan.orti@miceliux.com>
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import sys
+import argparse
+import os
+import time
+import datetime
+import shutil
+import hashlib
+import logging
+import collections
+import json
+import threading
+import random
+import math
+import re
+import imp
+import resource
+import subprocess
+import tempfile
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+FOLDER_MIMETYPE = u'application/vnd.google-apps.folder'
+DOCUMENT_MIMETYPE = u'application/vnd.google-apps.document'
+EXPORT_MIMETYPES = [u'application/vnd.oasis.opendocument.text',
+                    u'application/pdf']
+EXPORT_SIZE = 16 * 1024
+PATTERN_SIZE = 64 * 1024
+
+# The sync runs of a benchmark, in order, with the options of each one
+PHASES = collections.OrderedDict([
+    # Empty working dir
+    ('initial', {'incremental': True}),
+    # Whole list again, nothing to download
+    ('unchanged', {}),
+    # Some files modified, deleted and added in Drive
+    ('changes', {'incremental': True, 'mutate': True}),
+    # Every local file hashed
+    ('verify', {'verify': True}),
+])
+
+
+def content_pattern(key):
+    """ Returns the block of PATTERN_SIZE bytes repeated in a content
+    """
+    block = hashlib.sha256(key.encode('utf-8')).digest()
+    return block * (PATTERN_SIZE // len(block))
+
+
+def content_range(key, size, start, end):
+    """ Returns the bytes from start to end, both included, of a content
+    """
+    end = min(end, size - 1)
+    pattern = content_pattern(key)
+    offset = start % PATTERN_SIZE
+    length = end - start + 1
+    data = pattern[offset:] + pattern * (length // PATTERN_SIZE + 1)
+    return data[:length]
+
+
+def content_md5(key, size):
+    pattern = content_pattern(key)
+    m = hashlib.md5()
+    (blocks, rest) = divmod(size, PATTERN_SIZE)
+    for n in range(blocks):
+        m.update(pattern)
+    m.update(pattern[:rest])
+    return m.hexdigest()
+
+
+class Account(object):
+    """ A synthetic Drive account. The content of a file is a pattern
+    derived from its content key, repeated up to its size, so it can be
+    served from any offset without keeping it in memory. Duplicated
+    files share their content key. Every change is recorded for the
+    changes list.
+    """
+
+    def __init__(self, base_url, files, depth, files_per_folder,
+                 median_size, size_sigma, max_size, duplicate_ratio,
+                 doc_ratio, seed):
+        self.base_url = base_url
+        self.median_size = median_size
+        self.size_sigma = size_sigma
+        self.max_size = max_size
+        self.duplicate_ratio = duplicate_ratio
+        self.doc_ratio = doc_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.contents = {}
+        self.order = []
+        self.changes = []
+        self.md5s = {}
+        self.serial = 0
+        self.folders = [None]
+        levels = [[None]]
+        for n in range(max(1, files // files_per_folder)):
+            level = min(self.random.randint(1, max(1, depth)), len(levels))
+            parent = self.random.choice(levels[level - 1])
+            folder_id = self.add_folder(parent)
+            if len(levels) == level:
+                levels.append([])
+            levels[level].append(folder_id)
+            self.folders.append(folder_id)
+        for n in range(files):
+            self.add_file(self.random.choice(self.folders))
+        # Drive doesn't list the folders before their children
+        self.random.shuffle(self.order)
+        self.changes = []
+
+    def new_resource(self, title, mime, parent):
+        self.serial += 1
+        file_id = u'f{n:08d}'.format(n=self.serial)
+        resource = {'id': file_id,
+                    'title': title.format(n=self.serial),
+                    'mimeType': mime,
+                    'parents': [{'id': parent or u'root',
+                                 'isRoot': parent is None}],
+                    'modifiedDate': self.timestamp(),
+                    'labels': {'trashed': False}}
+        return resource
+
+    def timestamp(self):
+        date = datetime.datetime(2014, 1, 1) + datetime.timedelta(seconds=self.serial)
+        return date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def add_folder(self, parent):
+        resource = self.new_resource(u'Folder {n}', FOLDER_MIMETYPE, parent)
+        self.save(resource)
+        return resource['id']
+
+    def add_file(self, parent):
+        if self.random.random() < self.doc_ratio:
+            resource = self.new_resource(u'Document {n}', DOCUMENT_MIMETYPE, parent)
+            resource['exportLinks'] = dict(
+                (mime, u'{b}export/{i}?{q}'.format(
+                        b=self.base_url, i=resource['id'],
+                        q=urllib.urlencode({'mimeType': mime})))
+                for mime in EXPORT_MIMETYPES)
+            self.save(resource)
+            return
+        resource = self.new_resource(u'File {n}.bin', u'application/octet-stream', parent)
+        resource['fileExtension'] = u'bin'
+        resource['downloadUrl'] = u'{b}download/{i}'.format(b=self.base_url,
+                                                            i=resource['id'])
+        self.set_content(resource)
+        self.save(resource)
+
+    def set_content(self, resource):
+        """ Gives new content to a file, or the content of another file
+        """
+        if self.contents and self.random.random() < self.duplicate_ratio:
+            (key, size) = self.random.choice(self.contents.values())
+        else:
+            key = u'{i}-{d}'.format(i=resource['id'], d=resource['modifiedDate'])
+            size = int(min(self.max_size, self.random.lognormvariate(
+                        math.log(self.median_size), self.size_sigma)))
+        if (key, size) not in self.md5s:
+            self.md5s[(key, size)] = content_md5(key, size)
+        resource['md5Checksum'] = self.md5s[(key, size)]
+        resource['fileSize'] = str(size)
+        self.contents[resource['id']] = (key, size)
+
+    def save(self, resource):
+        if resource['id'] not in self.resources:
+            self.order.append(resource['id'])
+        self.resources[resource['id']] = resource
+        self.changes.append((resource['id'], resource))
+
+    def mutate(self, ratio):
+        """ Modifies, deletes and adds a ratio of the files each
+        """
+        with self.lock:
+            ids = [file_id for file_id in self.order
+                   if self.resources[file_id]['mimeType'] != FOLDER_MIMETYPE]
+            count = int(len(ids) * ratio)
+            sample = self.random.sample(ids, min(len(ids), 2 * count))
+            for file_id in sample[:count]:
+                self.serial += 1
+                resource = dict(self.resources[file_id],
+                                modifiedDate=self.timestamp())
+                if file_id in self.contents:
+                    self.set_content(resource)
+                self.save(resource)
+            for file_id in sample[count:]:
+                del self.resources[file_id]
+                self.contents.pop(file_id, None)
+                self.order.remove(file_id)
+                self.changes.append((file_id, None))
+            for n in range(count):
+                self.add_file(self.random.choice(self.folders))
+
+    def summary(self):
+        sizes = [size for (key, size) in self.contents.itervalues()]
+        return {'folders': len(self.folders) - 1,
+                'files': len(self.order) - len(self.folders) + 1,
+                'bytes': sum(sizes),
+                'unique_bytes': sum(size for (key, size) in set(self.contents.itervalues()))}
+
+
+QUERY_TOKEN = re.compile(r"""\s*(?:('(?:[^'\\]|\\.)*')|(!=|<=|>=|=|<|>|\(|\))|(\w+))""")
+
+
+def parse_query(query):
+    """ Compiles a query of the files.list method into a function telling
+    if a File resource matches it. Only the subset of the query language
+    used by drive-downloader is supported: and, or, not, parentheses,
+    'ID' in parents and comparisons of title, mimeType, modifiedDate and
+    trashed.
+    """
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = QUERY_TOKEN.match(query, position)
+        if match is None or match.end() == position:
+            raise ValueError("Invalid query: {q}".format(q=query))
+        (string, symbol, word) = match.groups()
+        if string is not None:
+            tokens.append(('string', re.sub(r'\\(.)', r'\1', string[1:-1])))
+        else:
+            tokens.append(('symbol', symbol or word))
+        position = match.end()
+    tokens.append(('end', None))
+    fields = {'title': lambda r: r['title'],
+              'mimeType': lambda r: r['mimeType'],
+              'modifiedDate': lambda r: r['modifiedDate'],
+              'trashed': lambda r: r['labels']['trashed']}
+    operators = {'=': lambda a, b: a == b,
+                 '!=': lambda a, b: a != b,
+                 '<': lambda a, b: a < b,
+                 '<=': lambda a, b: a <= b,
+                 '>': lambda a, b: a > b,
+                 '>=': lambda a, b: a >= b,
+                 'contains': lambda a, b: b in a}
+
+    def next_token():
+        return tokens.pop(0)
+
+    def expect(symbol):
+        if next_token() != ('symbol', symbol):
+            raise ValueError("Invalid query: {q}".format(q=query))
+
+    def expression():
+        terms = [term()]
+        while tokens[0] == ('symbol', 'or'):
+            next_token()
+            terms.append(term())
+        return lambda r: any(t(r) for t in terms)
+
+    def term():
+        factors = [factor()]
+        while tokens[0] == ('symbol', 'and'):
+            next_token()
+            factors.append(factor())
+        return lambda r: all(f(r) for f in factors)
+
+    def factor():
+        (kind, value) = next_token()
+        if (kind, value) == ('symbol', 'not'):
+            negated = factor()
+            return lambda r: not negated(r)
+        if (kind, value) == ('symbol', '('):
+            inner = expression()
+            expect(')')
+            return inner
+        if kind == 'string':
+            expect('in')
+            expect('parents')
+            return lambda r: any(p['id'] == value for p in r['parents'])
+        if value not in fields:
+            raise ValueError("Unsupported field: {f}".format(f=value))
+        field = fields[value]
+        operator = operators[next_token()[1]]
+        (kind, operand) = next_token()
+        if kind == 'symbol':
+            operand = operand == 'true'
+        return lambda r: operator(field(r), operand)
+
+    matches = expression()
+    if tokens[0][0] != 'end':
+        raise ValueError("Invalid query: {q}".format(q=query))
+    return matches
+
+
+def discovery_document(base_url):
+    """ Returns the part of the discovery document of the Drive API v2
+    used by drive-downloader
+    """
+    string = {'type': 'string', 'location': 'query'}
+    integer = {'type': 'integer', 'location': 'query'}
+    boolean = {'type': 'boolean', 'location': 'query'}
+    return {'kind': 'discovery#restDescription',
+            'discoveryVersion': 'v1',
+            'id': 'drive:v2',
+            'name': 'drive',
+            'version': 'v2',
+            'protocol': 'rest',
+            'rootUrl': base_url,
+            'servicePath': 'drive/v2/',
+            'baseUrl': base_url + 'drive/v2/',
+            'batchPath': 'batch/drive/v2',
+            'parameters': {'fields': string},
+            'schemas': dict((name, {'id': name, 'type': 'object'}) for name in
+                            ('FileList', 'ChangeList', 'StartPageToken')),
+            'resources': {
+                'files': {'methods': {
+                        'list': {'id': 'drive.files.list',
+                                 'path': 'files',
+                                 'httpMethod': 'GET',
+                                 'parameters': {'maxResults': integer,
+                                                'pageToken': string,
+                                                'q': string},
+                                 'response': {'$ref': 'FileList'}}}},
+                'changes': {'methods': {
+                        'list': {'id': 'drive.changes.list',
+                                 'path': 'changes',
+                                 'httpMethod': 'GET',
+                                 'parameters': {'maxResults': integer,
+                                                'pageToken': string,
+                                                'includeDeleted': boolean},
+                                 'response': {'$ref': 'ChangeList'}},
+                        'getStartPageToken': {'id': 'drive.changes.getStartPageToken',
+                                              'path': 'changes/startPageToken',
+                                              'httpMethod': 'GET',
+                                              'parameters': {},
+                                              'response': {'$ref': 'StartPageToken'}}}}}}
+
+
+class FakeDriveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Local stand-in for the Drive API v2 serving an Account. It counts
+    the requests by endpoint and the bytes of content served, and fails
+    a ratio of the requests like the API does under load.
+    """
+    daemon_threads = True
+
+    def __init__(self, error_rate, seed):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeDriveHandler)
+        self.base_url = 'http://127.0.0.1:{p}/'.format(p=self.server_port)
+        self.account = None
+        self.queries = {}
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Returns the counters and starts new ones
+        """
+        with self.lock:
+            counters = getattr(self, 'counters', None)
+            self.counters = {'api_calls': collections.Counter(),
+                             'errors': 0,
+                             'bytes_served': 0,
+                             'first_download': None}
+        return counters
+
+    def query(self, query):
+        """ Returns the IDs of the files matching a query, in listing
+        order. The results are kept until the account changes, so the
+        pages of a query don't evaluate it again.
+        """
+        key = (query, len(self.account.changes))
+        file_ids = self.queries.get(key)
+        if file_ids is None:
+            matches = parse_query(query.decode('utf-8'))
+            file_ids = [file_id for file_id in self.account.order
+                        if matches(self.account.resources[file_id])]
+            self.queries = {key: file_ids}
+        return file_ids
+
+    def count(self, endpoint, content=0):
+        with self.lock:
+            self.counters['api_calls'][endpoint] += 1
+            self.counters['bytes_served'] += content
+            if content and self.counters['first_download'] is None:
+                self.counters['first_download'] = time.time()
+
+    def inject_error(self):
+        """ Returns an error (status, reason) for a ratio of the requests,
+        otherwise None
+        """
+        with self.lock:
+            if self.random.random() >= self.error_rate:
+                return None
+            self.counters['errors'] += 1
+            return self.random.choice([(503, 'backendError'),
+                                       (403, 'userRateLimitExceeded'),
+                                       (500, 'internalError')])
+
+
+class FakeDriveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        path = url.path.strip('/').split('/')
+        if path == ['discovery', 'v1', 'apis', 'drive', 'v2', 'rest']:
+            self.server.count('discovery')
+            return self.send_json(discovery_document(self.server.base_url))
+        error = self.server.inject_error()
+        if error is not None:
+            (status, reason) = error
+            return self.send_json({'error': {'code': status,
+                                              'message': reason,
+                                              'errors': [{'reason': reason}]}},
+                                  status)
+        if path == ['drive', 'v2', 'files']:
+            self.list_files(query)
+        elif path == ['drive', 'v2', 'changes', 'startPageToken']:
+            self.server.count('changes.getStartPageToken')
+            with self.server.account.lock:
+                token = str(len(self.server.account.changes))
+            self.send_json({'startPageToken': token})
+        elif path == ['drive', 'v2', 'changes']:
+            self.list_changes(query)
+        elif len(path) == 2 and path[0] == 'download':
+            self.download(path[1])
+        elif len(path) == 2 and path[0] == 'export':
+            self.export(path[1], query.get('mimeType', ''))
+        else:
+            self.send_json({'error': {'code': 404, 'message': 'Not Found'}}, 404)
+
+    def list_files(self, query):
+        self.server.count('files.list')
+        account = self.server.account
+        start = int(query.get('pageToken', 0))
+        end = start + min(int(query.get('maxResults', 100)), 1000)
+        with account.lock:
+            if 'q' in query:
+                try:
+                    file_ids = self.server.query(query['q'])
+                except ValueError as e:
+                    return self.send_json({'error': {'code': 400, 'message': str(e)}}, 400)
+            else:
+                file_ids = account.order
+            items = [account.resources[file_id]
+                     for file_id in file_ids[start:end]]
+            more = end < len(file_ids)
+        result = {'items': items}
+        if more:
+            result['nextPageToken'] = str(end)
+        self.send_json(result)
+
+    def list_changes(self, query):
+        self.server.count('changes.list')
+        account = self.server.account
+        start = int(query.get('pageToken', 0))
+        end = start + min(int(query.get('maxResults', 100)), 1000)
+        items = []
+        with account.lock:
+            for (file_id, item) in account.changes[start:end]:
+                if item is None:
+                    items.append({'fileId': file_id, 'deleted': True})
+                else:
+                    items.append({'fileId': file_id, 'deleted': False,
+                                  'file': item})
+            total = len(account.changes)
+        result = {'items': items}
+        if end < total:
+            result['nextPageToken'] = str(end)
+        else:
+            result['newStartPageToken'] = str(total)
+        self.send_json(result)
+
+    def download(self, file_id):
+        with self.server.account.lock:
+            content = self.server.account.contents.get(file_id)
+        if content is None:
+            return self.send_json({'error': {'code': 404, 'message': 'Not Found'}}, 404)
+        (key, size) = content
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+        if match is None:
+            data = content_range(key, size, 0, size - 1) if size else ''
+            self.server.count('download', len(data))
+            return self.send_data(data)
+        start = int(match.group(1))
+        end = int(match.group(2) or size - 1)
+        if start >= size:
+            self.server.count('download')
+            return self.send_data('', 416,
+                                  {'Content-Range': 'bytes */{s}'.format(s=size)})
+        data = content_range(key, size, start, end)
+        self.server.count('download', len(data))
+        self.send_data(data, 206, {'Content-Range': 'bytes {s}-{e}/{t}'.format(
+                    s=start, e=start + len(data) - 1, t=size)})
+
+    def export(self, file_id, mime):
+        with self.server.account.lock:
+            resource = self.server.account.resources.get(file_id)
+        if resource is None:
+            return self.send_json({'error': {'code': 404, 'message': 'Not Found'}}, 404)
+        key = u'{i}-{d}-{m}'.format(i=file_id, d=resource['modifiedDate'], m=mime)
+        data = content_range(key, EXPORT_SIZE, 0, EXPORT_SIZE - 1)
+        self.server.count('export', len(data))
+        self.send_data(data)
+
+    def send_json(self, value, status=200):
+        self.send_data(json.dumps(value), status,
+                       {'Content-Type': 'application/json'})
+
+    def send_data(self, data, status=200, headers={}):
+        self.send_response(status)
+        for (name, value) in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def read_io():
+    """ Returns the I/O counters of this process and its finished children,
+    or None if they aren't available (not Linux)
+    """
+    try:
+        with open('/proc/self/io') as fh:
+            return dict((name, int(value)) for (name, value) in
+                        (line.split(':') for line in fh))
+    except (IOError, ValueError):
+        return None
+
+
+def script_version(script):
+    """ Returns the git description of the script's checkout and the MD5
+    of the script, to tell the versions compared apart
+    """
+    try:
+        describe = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(script), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        describe = None
+    with open(script, 'rb') as fh:
+        md5 = hashlib.md5(fh.read()).hexdigest()
+    return {'git': describe, 'md5': md5}
+
+
+def run_phase(options):
+    """Runs a sync against the fake server in this process and prints its
+    measures as JSON
+    """
+    import httplib2
+    from googleapiclient.discovery import build
+
+    dd = imp.load_source('drive_downloader', options['script'])
+    discovery_url = options['base_url'] + 'discovery/v1/apis/{api}/{apiVersion}/rest'
+
+    class BenchmarkDrive(dd.Drive):
+        """ Drive using the fake server, without credentials
+        """
+        def load_credentials(self, client_secrets):
+            self.credentials = None
+
+        def new_http(self):
+            return httplib2.Http()
+
+        def authorize(self):
+            self.drive_service = build('drive', 'v2', http=self.new_http(),
+                                       discoveryServiceUrl=discovery_url,
+                                       cache_discovery=False)
+
+    os.chdir(options['working_dir'])
+    measures = {'started': time.time()}
+    start = time.time()
+    drive = BenchmarkDrive(None, dd.OPENDOCUMENT_CONVERSION,
+                           verify=options['verify'],
+                           incremental=options['incremental'],
+                           jobs=options['jobs'],
+                           rate=options['rate'],
+                           hash_jobs=options['hash_jobs'],
+                           sync_filter=dd.SyncFilter(**options['filter']),
+                           bandwidth=options['bandwidth'])
+    drive.authorize()
+    measures['authorize'] = time.time() - start
+    mark = time.time()
+    drive.start_scan()
+    plan = drive.sync()
+    measures['sync'] = time.time() - mark
+    mark = time.time()
+    drive.close()
+    measures['close'] = time.time() - mark
+    measures['wall'] = time.time() - start
+    measures['files_listed'] = len(drive.tree.files)
+    measures['plan'] = {'keep': len(plan.keep),
+                        'download': len(plan.download),
+                        'backup': len(plan.backup),
+                        'fix_mtime': len(plan.fix_mtime)}
+    measures['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    measures['metrics'] = drive.metrics.to_dict()
+    print(json.dumps(measures))
+
+
+def run_benchmark(args):
+    """Runs the phases against a synthetic account and returns the results
+    """
+    script = os.path.abspath(args.script)
+    server = FakeDriveServer(args.error_rate, args.seed)
+    logging.info("Generating an account with {n} files...".format(n=args.files))
+    server.account = Account(server.base_url, args.files, args.depth,
+                             args.files_per_folder, args.median_size,
+                             args.size_sigma, args.max_size,
+                             args.duplicate_ratio, args.doc_ratio, args.seed)
+    thread = threading.Thread(target=server.serve_forever, name="FakeDriveServer")
+    thread.daemon = True
+    thread.start()
+    working_dir = args.working_dir or tempfile.mkdtemp(prefix='drive-benchmark-')
+    if not os.path.isdir(working_dir):
+        os.makedirs(working_dir)
+    results = {'script': script,
+               'version': script_version(script),
+               'date': datetime.datetime.now().isoformat(),
+               'python': sys.version.split()[0],
+               'options': dict((name, value) for (name, value) in vars(args).iteritems()
+                               if name not in ('phase', 'compare', 'output')),
+               'account': server.account.summary(),
+               'phases': []}
+    try:
+        for name in args.phases:
+            phase = PHASES[name]
+            if phase.get('mutate'):
+                server.account.mutate(args.change_ratio)
+            options = {'script': script,
+                       'base_url': server.base_url,
+                       'working_dir': working_dir,
+                       'verify': phase.get('verify', False),
+                       'incremental': phase.get('incremental', False),
+                       'jobs': args.jobs,
+                       'rate': args.rate,
+                       'hash_jobs': args.hash_jobs,
+                       'bandwidth': args.bandwidth,
+                       'filter': {'include_paths': args.include,
+                                  'exclude_paths': args.exclude,
+                                  'include_mimes': args.include_mime,
+                                  'exclude_mimes': args.exclude_mime,
+                                  'max_size': args.max_file_size}}
+            logging.info("Running phase {p}...".format(p=name))
+            server.reset()
+            io_before = read_io()
+            # A new interpreter for every phase, so the peak memory usage
+            # is its own
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 '--log-level', args.log_level,
+                 '--phase', json.dumps(options)])
+            io_after = read_io()
+            counters = server.reset()
+            measures = json.loads(output.strip().splitlines()[-1])
+            measures['name'] = name
+            measures['api_calls'] = dict(counters['api_calls'])
+            measures['api_errors'] = counters['errors']
+            measures['bytes_served'] = counters['bytes_served']
+            if counters['first_download'] is not None:
+                measures['first_download'] = counters['first_download'] - measures['started']
+            else:
+                measures['first_download'] = None
+            measures['throughput_mib_s'] = counters['bytes_served'] / 1048576.0 / measures['sync']
+            measures['files_per_s'] = measures['files_listed'] / measures['sync']
+            if io_before is not None and io_after is not None:
+                measures['disk_read_bytes'] = io_after['read_bytes'] - io_before['read_bytes']
+            else:
+                measures['disk_read_bytes'] = None
+            del measures['started']
+            logging.info("{p}: {w:.2f} s, {t:.1f} MiB/s, {c} API calls, {m:.1f} MiB peak memory".format(
+                    p=name, w=measures['wall'], t=measures['throughput_mib_s'],
+                    c=sum(measures['api_calls'].itervalues()),
+                    m=measures['peak_rss_kb'] / 1024.0))
+            results['phases'].append(measures)
+    finally:
+        server.shutdown()
+        if not args.keep and not args.working_dir:
+            shutil.rmtree(working_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, old_results):
+    """Prints the change of the times of every phase against older results
+    """
+    old_phases = dict((phase['name'], phase) for phase in old_results['phases'])
+    for phase in results['phases']:
+        old = old_phases.get(phase['name'])
+        if old is None:
+            continue
+        for measure in ('wall', 'sync', 'peak_rss_kb'):
+            if old[measure]:
+                change = (phase[measure] - old[measure]) * 100.0 / old[measure]
+                print("{p} {m}: {n:.2f} (was {o:.2f}, {c:+.1f}%)".format(
+                        p=phase['name'], m=measure, n=phase[measure],
+                        o=old[measure], c=change))
+
+
+def main(argv):
+    script_default = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                  "drive-downloader.py")
+
+    program_description = """Benchmark of drive-downloader against a local
+    fake Drive API server serving a synthetic account. The measures of every
+    phase are saved as JSON."""
+
+    parser = argparse.ArgumentParser(description=program_description)
+    parser.add_argument("-f", "--files", type=int, default=10000,
+                        help="Number of files (default: 10000)")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="Depth of the folder tree (default: 4)")
+    parser.add_argument("--files-per-folder", type=int, default=20,
+                        help="Average number of files per folder (default: 20)")
+    parser.add_argument("--median-size", type=int, default=64 * 1024,
+                        help="Median file size in bytes (default: 65536)")
+    parser.add_argument("--size-sigma", type=float, default=1.5,
+                        help="Spread of the log-normal file sizes (default: 1.5)")
+    parser.add_argument("--max-size", type=int, default=64 * 1024 * 1024,
+                        help="Maximum file size in bytes (default: 67108864)")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1,
+                        help="Ratio of files duplicating another one (default: 0.1)")
+    parser.add_argument("--doc-ratio", type=float, default=0.05,
+                        help="Ratio of Google documents (default: 0.05)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Ratio of requests failing (default: 0)")
+    parser.add_argument("--change-ratio", type=float, default=0.01,
+                        help="Ratio of files modified, deleted and added before the changes phase (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the account generator (default: 0)")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of files to download in parallel (default: 4)")
+    parser.add_argument("--hash-jobs", type=int, default=None,
+                        help="Number of processes hashing local files (default: the number of CPUs)")
+    parser.add_argument("-r", "--rate", type=float, default=0,
+                        help="Maximum number of requests per second, 0 for no limit (default: 0)")
+    parser.add_argument("--bandwidth", type=int, default=0,
+                        help="Maximum download bandwidth in bytes per second, 0 for no limit (default: 0)")
+    parser.add_argument("--include", action="append", default=[],
+                        help="Folder to sync, like 'Folder 1/Folder 2' (default: all of them)")
+    parser.add_argument("--exclude", action="append", default=[],
+                        help="Pattern of the paths not to sync")
+    parser.add_argument("--include-mime", action="append", default=[],
+                        help="Pattern of the mime types to sync")
+    parser.add_argument("--exclude-mime", action="append", default=[],
+                        help="Pattern of the mime types not to sync")
+    parser.add_argument("--max-file-size", type=int,
+                        help="Maximum size of the files to sync")
+    parser.add_argument("-p", "--phases", nargs='+', choices=PHASES.keys(),
+                        default=PHASES.keys(),
+                        help="Phases to run (default: all of them)")
+    parser.add_argument("-w", "--working-dir",
+                        help="Directory to sync to (default: a temporary one)")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the temporary working dir")
+    parser.add_argument("-s", "--script", default=script_default,
+                        help="drive-downloader script to benchmark (default: drive-downloader.py)")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="JSON file to save the results to (default: benchmark.json)")
+    parser.add_argument("--compare",
+                        help="JSON file with older results to compare with")
+    parser.add_argument("-l", "--log-level", default="info",
+                        choices=["debug", "info", "warning", "error", "critical"],
+                        help="Verbosity level")
+    parser.add_argument("--phase", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    numeric_level = getattr(logging, args.log_level.upper())
+    if args.phase:
+        # drive-downloader logs at least warnings, the benchmark only
+        # reports the measures
+        logging.basicConfig(level=max(numeric_level, logging.WARNING))
+        run_phase(json.loads(args.phase))
+        return
+    logging.basicConfig(level=numeric_level)
+    results = run_benchmark(args)
+    with open(args.output, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    logging.info("Results saved to {f}".format(f=args.output))
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -22,6 +22,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
 import sys
 import argparse
+import httplib
 import httplib2
 import os
 import datetime
@@ -29,20 +30,56 @@ import time
 import shutil
 import hashlib
 import logging
+import collections
+import sqlite3
+import json
+import threading
+import Queue
+import random
+import socket
+import fcntl
+import stat
+import multiprocessing
+import resource
+import contextlib
+import heapq
+import fnmatch
+import re
+# time.strptime imports it on the first call, which isn't thread safe
+import _strptime
 
-from lockfile import LockFile
+from lockfile import LockFile, LockError
 from googleapiclient.discovery import build
 from googleapiclient import errors
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Errors raised by the requests which are worth retrying, httplib's are
+# raised when a connection drops in the middle of a response
+NETWORK_ERRORS = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error)
+
 
 class Drive(object):
     """ The Drive class represents the whole Drive unit
     """
     OAUTH2_STORAGE = u'.oauth2.json'
+    MANIFEST = u'.manifest.sqlite'
     TRASH_FOLDER = u'./.Trash'
     BACKUP_FOLDER = u'./.Backups'
+    EXPORTS_FOLDER = u'./.Exports'
     IGNORE_MIMETYPES = frozenset([u'application/vnd.google-apps.audio',
                         #u'application/vnd.google-apps.document',
                         #u'application/vnd.google-apps.drawing',
@@ -66,17 +103,70 @@ class Drive(object):
                        u'application/pdf': u'.pdf'
                        }
     FALLBACK_MIMETYPE = u'application/pdf'
+    FOLDER_MIMETYPE = u'application/vnd.google-apps.folder'
+    PARTIAL_SUFFIX = u'.part'
+    PAGE_SIZE = 1000
+    # Folders listed by a single query when listing by folder
+    PARENTS_PER_QUERY = 50
+    # Only the fields of the File resources used to sync
+    FILE_FIELDS = ('id,title,mimeType,parents(id,isRoot),md5Checksum,fileSize,'
+                   'modifiedDate,labels/trashed,exportLinks,downloadUrl,fileExtension')
+    SIDECAR_SUFFIX = u'.json'
+    CHUNK_SIZE = 4 * 1024 * 1024
 
-    def __init__(self, client_secrets, conversion):
+    def __init__(self, client_secrets, conversion, verify=False,
+                 incremental=False, jobs=1, rate=10, hash_jobs=None,
+                 metrics_file=None, sync_filter=None, bandwidth=0,
+                 bandwidth_windows=(), working_dir=u'.', oauth_storage=None,
+                 shared=None, name=None):
+        self.root = working_dir
+        self.name = name
+        self.trash_folder = self.local_path(self.TRASH_FOLDER)
+        self.backup_folder = self.local_path(self.BACKUP_FOLDER)
+        self.exports_folder = self.local_path(self.EXPORTS_FOLDER)
+        self.oauth_storage = oauth_storage or self.local_path(self.OAUTH2_STORAGE)
+        self.conversion = conversion
+        self.filter = sync_filter or SyncFilter()
+        self.verify = verify
+        self.incremental = incremental
+        self.jobs = jobs
+        self.hash_jobs = hash_jobs or multiprocessing.cpu_count()
+        self.shared = shared
+        if shared is None:
+            self.pool = None
+            self.https = HttpPool()
+            self.download_slots = threading.BoundedSemaphore(max(1, jobs))
+            self.bandwidth = BandwidthLimiter(bandwidth, bandwidth_windows)
+        else:
+            self.pool = shared.pool
+            self.https = shared.https
+            self.download_slots = shared.download_slots
+            self.bandwidth = shared.bandwidth
+        self.scan = None
+        self.stopping = threading.Event()
+        self.metrics = Metrics(metrics_file,
+                               None if name is None else {'account': name})
+        self.executor = RequestExecutor(rate, self.metrics)
+        self.listing_complete = False
+        self.dir_lock = threading.Lock()
+        self.plan = None
+        self.remote = {}
+        self.failed = set()
+        self.manifest = Manifest(self.local_path(self.MANIFEST), self.root)
+        self.load_credentials(client_secrets)
+
+    def load_credentials(self, client_secrets):
+        """ Loads the OAuth2 credentials from the storage file, or asks for
+        them if they aren't stored yet
+        """
         # Check https://developers.google.com/drive/scopes for all available scopes
         OAUTH_SCOPE = 'https://www.googleapis.com/auth/drive'
         # Redirect URI for installed apps
         REDIRECT_URI = 'urn:ietf:wg:oauth:2.0:oob'
-        self.conversion = conversion
-        self.storage = Storage(self.OAUTH2_STORAGE)
+        self.storage = Storage(self.oauth_storage)
         self.credentials = self.storage.get()
         if self.credentials is None:
-            print("Credentials file not found at: {storage}".format(storage=self.OAUTH2_STORAGE))
+            print("Credentials file not found at: {storage}".format(storage=self.oauth_storage.encode('utf-8')))
             # Run through the OAuth flow and retrieve credentials
             flow = flow_from_clientsecrets(client_secrets,
                                            scope=OAUTH_SCOPE,
@@ -87,64 +177,332 @@ class Drive(object):
             self.credentials = flow.step2_exchange(code)
             self.storage.put(self.credentials)
 
+    def close(self):
+        """ Stops the local scan and the hashing processes, unless they are
+        shared, and flushes and closes the local manifest
+        """
+        if self.scan is not None:
+            self.scan.close()
+            self.scan = None
+        if self.pool is not None and self.shared is None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.manifest.close()
+
     def authorize(self):
         """ Create an httplib2.Http object and authorize it with
         our credentials
         """
+        with self.metrics.timer('authorize'):
+            self.drive_service = build('drive', 'v2', http=self.new_http())
+
+    def new_http(self):
+        """ Returns a new httplib2.Http object authorized with our
+        credentials. httplib2 is not thread-safe, so every thread needs
+        its own one.
+        """
         http = httplib2.Http()
-        http = self.credentials.authorize(http)
-        self.drive_service = build('drive', 'v2', http=http)
+        return self.credentials.authorize(http)
+
+    def acquire_http(self):
+        """ Returns an authorized httplib2.Http object for a thread. The
+        ones released are reused, so their connections are kept open.
+        """
+        return self.https.acquire(self) or self.new_http()
+
+    def release_http(self, http):
+        self.https.release(self, http)
 
-    def get_filelist(self):
-        """Retrieve a list of File resources.
+    def local_path(self, path):
+        """ Returns the local path of a path relative to the working dir
+        """
+        if self.root == u'.':
+            return path
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def relative_path(self, path):
+        """ Returns a local path relative to the working dir
+        """
+        path = os.path.normpath(path)
+        if self.root != u'.':
+            if path == self.root:
+                return u'.'
+            if path.startswith(self.root + os.sep):
+                return path[len(self.root) + 1:]
+        return path
 
-        Args:
-          service: Drive API service instance.
-        Returns:
-          List of File resources.
+    def thread_name(self, name):
+        """ Returns the name of a thread working for this Drive
         """
-        self.drive_files = []
+        if self.name is None:
+            return name
+        return "{a}/{t}".format(a=self.name.encode('utf-8'), t=name)
+
+    def get_filelist(self, on_page=None):
+        """Retrieve the list of File resources and index it in self.tree.
+
+        In incremental mode, the list saved in the manifest is updated
+        with the changes since the last run. The whole list is only
+        retrieved on the first run or if the change token is no longer
+        valid. When it's retrieved, on_page is called with the DriveFile
+        list of every page once it's indexed.
+
+        Returns True if the list is complete"""
+        self.tree = FileTree(self)
+        self.plan = None
+        if self.incremental:
+            change_token = self.manifest.get_state('change_token')
+            if self.manifest.get_state('filter') != self.filter.fingerprint():
+                # The list saved was selected by other rules
+                change_token = None
+            if change_token is not None:
+                self.tree.build(self.manifest.load_drive_files())
+                if self.apply_changes(change_token):
+                    self.listing_complete = True
+                    return True
+                logging.warning("Unable to retrieve the changes, listing all the files")
+        self.listing_complete = self.list_all_files(on_page)
+        return self.listing_complete
+
+    def list_all_files(self, on_page=None):
+        """Retrieve the whole list of File resources selected by the
+        rules, calling on_page with every page. With path rules, only the
+        folders selected are listed, see list_tree.
+        In incremental mode, the list is saved in the manifest along with
+        the change token to use in the next run.
+
+        Returns True if the list is complete"""
+        change_token = None
+        if self.incremental:
+            try:
+                result = self.executor.execute(
+                    self.drive_service.changes().getStartPageToken())
+                change_token = result['startPageToken']
+            except (errors.HttpError,) + NETWORK_ERRORS, error:
+                logging.error("An error occurred: {e}".format(e=error))
+        self.tree.build([])
+        if self.filter.path_rules:
+            folder_ids = self.find_include_folders(on_page)
+            complete = folder_ids is not None and \
+                self.list_tree(folder_ids, on_page)
+        else:
+            complete = self.list_files(self.filter.query(), on_page)
+        logging.info("{n} files listed".format(n=len(self.tree.files)))
+        if self.incremental:
+            # Never save an incomplete list, the next run would trust it
+            if complete and change_token is not None:
+                # The list is committed in batches: drop the old token
+                # first, so a run stopped while it's rewritten leaves no
+                # truncated list to be trusted
+                self.manifest.set_state('change_token', None)
+                self.manifest.commit()
+                self.manifest.save_drive_files(self.tree.files.itervalues())
+                self.manifest.set_state('change_token', change_token)
+                self.manifest.set_state('filter', self.filter.fingerprint())
+            else:
+                self.manifest.set_state('change_token', None)
+            self.manifest.commit()
+        return complete
+
+    def list_files(self, query, on_page=None, seen=None):
+        """Retrieve the File resources matching a query, or all of them
+        if it's None, adding them to the file tree and calling on_page
+        with every page. If seen is given, the files already in it are
+        skipped and the new ones added.
+
+        Returns True if the list is complete"""
         page_token = None
         while True:
             try:
-                param = {}
+                param = {'maxResults': self.PAGE_SIZE,
+                         'fields': 'nextPageToken,items({f})'.format(f=self.FILE_FIELDS)}
+                if query:
+                    param['q'] = query
                 if page_token:
                     param['pageToken'] = page_token
-                result = self.drive_service.files().list(**param).execute()
+                with self.metrics.timer('list_page'):
+                    result = self.executor.execute(
+                        self.drive_service.files().list(**param))
+            except (errors.HttpError,) + NETWORK_ERRORS, error:
+                logging.error("An error occurred: {e}".format(e=error))
+                return False
+            page = [DriveFile.from_resource(item) for item in result['items']]
+            if seen is not None:
+                page = [drive_file for drive_file in page
+                        if drive_file.id not in seen]
+                seen.update(drive_file.id for drive_file in page)
+            for drive_file in page:
+                self.tree.add(drive_file)
+            self.metrics.count('files_listed', len(page))
+            if on_page is not None:
+                on_page(page)
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return True
 
-                self.drive_files.extend(result['items'])
-                page_token = result.get('nextPageToken')
-                if not page_token:
+    def find_include_folders(self, on_page=None):
+        """Looks up the folders of the include rules and the ones above
+        them, adding them to the file tree.
+
+        Returns the IDs of the folders included or None if they couldn't
+        be retrieved"""
+        if not self.filter.include_paths:
+            return [u'root']
+        folder_ids = []
+        for include_path in self.filter.include_paths:
+            parent_ids = [u'root']
+            for title in include_path.split(os.sep):
+                if not parent_ids:
                     break
-            except errors.HttpError, error:
+                query = u"title = '{t}' and mimeType = '{m}' and trashed = false and ({p})".format(
+                    t=query_string(title), m=self.FOLDER_MIMETYPE,
+                    p=u' or '.join(u"'{i}' in parents".format(i=query_string(i))
+                                   for i in parent_ids))
+                page_ids = []
+                if not self.list_files(query, lambda page: page_ids.extend(
+                        drive_file.id for drive_file in page)):
+                    return None
+                if on_page is not None:
+                    on_page([self.tree.get(file_id) for file_id in page_ids])
+                parent_ids = page_ids
+            if not parent_ids:
+                logging.warning("Folder {f} not found in Drive".format(
+                        f=include_path.encode('utf-8')))
+            folder_ids.extend(parent_ids)
+        return folder_ids
+
+    def list_tree(self, folder_ids, on_page=None):
+        """Retrieve the File resources in the folders given and below
+        them, level by level, calling on_page with every page. The
+        folders excluded by the path rules aren't listed. The queries
+        cover PARENTS_PER_QUERY folders each.
+
+        Returns True if the list is complete"""
+        pending = list(folder_ids)
+        seen = set()
+        filter_query = self.filter.query()
+        while pending:
+            parent_ids = pending[:self.PARENTS_PER_QUERY]
+            del pending[:self.PARENTS_PER_QUERY]
+            query = u'({p})'.format(p=u' or '.join(
+                    u"'{i}' in parents".format(i=query_string(i)) for i in parent_ids))
+            if filter_query:
+                query = u'{p} and ({q})'.format(p=query, q=filter_query)
+            folders = []
+
+            def add_page(page):
+                folders.extend(drive_file for drive_file in page
+                               if drive_file.mime_type == self.FOLDER_MIMETYPE)
+                if on_page is not None:
+                    on_page(page)
+
+            if not self.list_files(query, add_page, seen):
+                return False
+            pending.extend(folder.id for folder in folders
+                           if self.in_scope(folder))
+        return True
+
+    def apply_changes(self, change_token, changed=None):
+        """Retrieve the changes since change_token and apply them to the
+        file tree and the list saved in the manifest. If changed is
+        given, the IDs of the files changed and their descendants are
+        added to it, with the path they had or None.
+
+        Returns True if successful, False if the changes couldn't be retrieved
+        """
+        changes = {}
+        new_token = None
+        page_token = change_token
+        while page_token:
+            try:
+                with self.metrics.timer('changes_page'):
+                    result = self.executor.execute(self.drive_service.changes().list(
+                        pageToken=page_token, includeDeleted=True,
+                        maxResults=self.PAGE_SIZE,
+                        fields='nextPageToken,newStartPageToken,items(fileId,deleted,file({f}))'.format(
+                            f=self.FILE_FIELDS)))
+            except (errors.HttpError,) + NETWORK_ERRORS, error:
                 logging.error("An error occurred: {e}".format(e=error))
-                break
+                return False
+            for change in result['items']:
+                if change.get('deleted') or 'file' not in change:
+                    changes[change['fileId']] = None
+                else:
+                    changes[change['fileId']] = DriveFile.from_resource(change['file'])
+            new_token = result.get('newStartPageToken', new_token)
+            page_token = result.get('nextPageToken')
+        if new_token is None:
+            return False
+        logging.info("Applying {n} changes".format(n=len(changes)))
+        self.metrics.count('changes', len(changes))
+        if changed is not None:
+            for file_id in changes:
+                changed.setdefault(file_id, None)
+                changed.update(self.tree.cached_paths(file_id))
+        new_folders = [file_id for (file_id, drive_file) in changes.iteritems()
+                       if drive_file is not None and
+                       drive_file.mime_type == self.FOLDER_MIMETYPE and
+                       self.tree.get(file_id) is None]
+        for (file_id, drive_file) in changes.iteritems():
+            if drive_file is None:
+                self.tree.remove(file_id)
+                self.manifest.delete_drive_file(file_id)
+            else:
+                self.tree.add(drive_file)
+                self.manifest.save_drive_file(drive_file)
+        # Leave out what the rules don't select, with everything below it
+        for (file_id, drive_file) in changes.iteritems():
+            if drive_file is not None and self.tree.get(file_id) is not None \
+                    and not self.selects(drive_file):
+                for removed_id in self.tree.subtree(file_id):
+                    self.tree.remove(removed_id)
+                    self.manifest.delete_drive_file(removed_id)
+        if self.filter.path_rules:
+            # The folders which appeared in the ones listed bring their
+            # content, it wasn't listed
+            folder_ids = [file_id for file_id in new_folders
+                          if self.tree.get(file_id) is not None]
+            listed = []
+            if folder_ids and not self.list_tree(folder_ids, listed.extend):
+                return False
+            for drive_file in listed:
+                self.manifest.save_drive_file(drive_file)
+                if changed is not None:
+                    changed.setdefault(drive_file.id, None)
+        self.manifest.set_state('change_token', new_token)
+        self.manifest.commit()
+        return True
 
     def resolve_final_mime(self, drive_file):
         """Analyzes a drive_file and returns a tuple with the final mime type,
         extension and a boolean (True=convert, False=do not convert)."""
-        mime = drive_file['mimeType']
+        mime = drive_file.mime_type
         convert = False
         if mime in self.conversion.keys():
-            if self.conversion[mime] in drive_file['exportLinks'].keys():
+            if self.conversion[mime] in (drive_file.export_links or {}):
                 mime = self.conversion[mime]
             else:
                 mime = self.FALLBACK_MIMETYPE
             extension = self.MIME_EXTENSIONS[mime]
             convert = True
         else:
-            extension = drive_file['fileExtension']
+            extension = drive_file.extension
         return (mime, extension, convert)
 
-    def download_file(self, drive_file):
-        """Download a file's content.
+    def download_file(self, drive_file, part, http=None):
+        """Download a file's content in chunks of CHUNK_SIZE bytes, using
+        ranged requests, and write it to a partial file. The download
+        starts at the offset already written to it.
 
           Args:
-        service: Drive API service instance.
         drive_file: Drive File instance.
+        part: PartialFile to write the content to.
+        http: authorized httplib2.Http instance to use, by default the
+        one of the Drive service.
 
           Returns:
-        File's content if successful, None otherwise.
+        True if successful, False otherwise.
         """
         # Authenticate every request because:
         # https://code.google.com/p/google-api-python-client/issues/detail?id=231
@@ -152,34 +510,70 @@ class Drive(object):
         #self.authorize()
         (mime, extension, convert) = self.resolve_final_mime(drive_file)
         if convert:
-            download_url = drive_file['exportLinks'][mime]
+            download_url = drive_file.export_links[mime]
         else:
-            download_url = drive_file['downloadUrl']
+            download_url = drive_file.download_url
         if download_url:
             if convert:
-                logging.info("Downloading converted file: {f}".format(f=drive_file['title'].encode('utf-8')))
-            else:
-                logging.info("Downloading file: {f}".format(f=drive_file['title'].encode('utf-8')))
-            resp, content = self.drive_service._http.request(download_url)
-            if resp.status == 200:
-                return content
+                logging.info("Downloading converted file: {f}".format(f=drive_file.title.encode('utf-8')))
             else:
-                logging.error("An error occurred: {e}".format(e=resp))
-                return None
+                logging.info("Downloading file: {f}".format(f=drive_file.title.encode('utf-8')))
+            if http is None:
+                http = self.drive_service._http
+            while True:
+                self.bandwidth.acquire()
+                headers = {'range': 'bytes={s}-{e}'.format(
+                        s=part.offset,
+                        e=part.offset + self.bandwidth.chunk_size(self.CHUNK_SIZE) - 1)}
+                resp, content = self.executor.request(http, download_url,
+                                                      headers=headers)
+                if resp.status in (200, 206):
+                    self.metrics.count('download_bytes', len(content))
+                    waited = self.bandwidth.consume(len(content))
+                    if waited:
+                        self.metrics.observe('bandwidth_wait', waited)
+                if resp.status == 206:
+                    total = resp.get('content-range', '').rpartition('/')[2]
+                    done = not content or not total.isdigit() or \
+                        part.offset + len(content) >= int(total)
+                    with self.metrics.timer('write'):
+                        part.write(content)
+                        if not done:
+                            # Only needed to resume the rest
+                            part.checkpoint()
+                    if done:
+                        return True
+                elif resp.status == 200:
+                    # The range was ignored (i.e. exports), this is the
+                    # whole content
+                    with self.metrics.timer('write'):
+                        if part.offset:
+                            part.reset()
+                        part.write(content)
+                    return True
+                elif resp.status == 416:
+                    # Nothing left to download, the file is empty or
+                    # it was already complete
+                    return True
+                else:
+                    logging.error("An error occurred: {e}".format(e=resp))
+                    return False
         else:
             # The file doesn't have any content stored on Drive.
-            return None
+            return False
 
     def get_time(self, drive_file):
         """ Returns a datetime object with the modified date of the file
         """
-        return time.strptime(drive_file['modifiedDate'],'%Y-%m-%dT%H:%M:%S.%fZ')
+        return time.strptime(drive_file.modified_date,'%Y-%m-%dT%H:%M:%S.%fZ')
 
     def isTrashed(self, drive_file):
         """ Returns True or False if the file is in the Trash
         """
-        if drive_file is None or drive_file['labels']['trashed'] is None:
-            logging.debug("Drive file {f} is trashed".format(f=drive_file['title'].encode('utf-8')))
+        if drive_file is None:
+            return True
+        if drive_file.trashed:
+            logging.debug("Drive file {f} is trashed".format(f=drive_file.title.encode('utf-8')))
             return True
         else:
             return False
@@ -188,87 +582,216 @@ class Drive(object):
     def parentIsRoot(self, drive_file):
         """ Returns True if parent folder is Root
         """
-        if drive_file['parents']:
-            return drive_file['parents'][0]['isRoot']
-        else:
-            return False
+        return drive_file.parent_is_root
 
     def get_drive_file_from_id(self, drive_file_id):
-        """ Searchs in the list of files and returns the one which
-        matches the ID.
+        """ Looks up the file which matches the ID in the file tree.
         Returns None if not found
         """
-        for drive_file in self.drive_files:
-            if drive_file['id'] == drive_file_id:
-                return drive_file
-        return None
+        return self.tree.get(drive_file_id)
 
     def get_path(self, drive_file):
         """ Returns the path of a file, with the name of the file included
         """
-        if self.isTrashed(drive_file):
-            file_path = os.path.join(self.TRASH_FOLDER, drive_file['title'])
-        elif self.parentIsRoot(drive_file):
-            file_path = drive_file['title']
-        elif drive_file['parents']:
-            parentId = drive_file['parents'][0]['id']
-            file_path = os.path.join(self.get_path(self.get_drive_file_from_id(parentId)),
-                                drive_file['title'])
-        elif drive_file['mimeType'] in self.conversion.keys():
-            (mime, extension, convert) = self.resolve_final_mime(drive_file)
-            file_path = drive_file['title'] + extension
-        else:
-            file_path = drive_file['title']
-        return file_path
+        return self.local_path(self.tree.get_path(drive_file))
 
 
-    def save_file(self, content, file_path, mtime):
-        """Writes to disk the given content, it needs the path and the modification
-        time of the file
-        """
-        dir = os.path.dirname(file_path)
-        if dir and not os.path.isdir(dir):
-            try:
-                os.makedirs(dir,  0700)
-            except OSError as e:
-                logging.error("Error {n} creating folder {f}: {s}".format(
-                    n=e.errno,
-                    f=dir.encode('utf-8'),
-                    s=e.strerror))
+    def save_file(self, drive_file, file_path, mtime, http=None):
+        """Downloads a file to a partial file next to file_path, hashing
+        it while it's written. Once complete and if the MD5 matches with
+        Drive's, it's moved into place and its modification time set.
+        If the download is interrupted, the partial file is kept to resume
+        it in the next run.
+
+        Returns the MD5 of the file if it was saved, None otherwise"""
+        self.make_dirs(os.path.dirname(file_path))
+        part_path = file_path + self.PARTIAL_SUFFIX
+        part = PartialFile(part_path, part_path + self.SIDECAR_SUFFIX, drive_file)
         try:
             logging.debug("Writing file {f} to disk".format(f=file_path.encode('utf-8')))
-            f = open(file_path, 'w')
-            f.write(content)
-            f.close()
+            part.open()
+            if not self.download_file(drive_file, part, http):
+                if not part.offset:
+                    part.discard()
+                return None
+            md5 = part.md5.hexdigest()
+            expected_md5 = drive_file.md5
+            if expected_md5 is not None and md5 != expected_md5:
+                logging.error("Downloaded file {f} md5 doesn't match with remote md5".format(
+                        f=file_path.encode('utf-8')))
+                part.discard()
+                return None
+            part.complete(file_path)
             # Set mtime to match Drive
             logging.debug("Setting mtime of file {f}".format(f=file_path.encode('utf-8')))
             set_mtime(file_path, mtime)
-        except IOError as e:
+            return md5
+        except (IOError, OSError) as e:
             logging.error("Error {n} writing file {f}: {e}".format(
                 n=e.errno,
-                f=e.filename.encode('utf-8'),
+                f=file_path.encode('utf-8'),
+                e=e.strerror))
+            return None
+        finally:
+            # Kept to be resumed if it wasn't completed nor discarded
+            part.close()
+
+    def make_dirs(self, dir):
+        """Creates a folder and its parents if they don't exist
+        """
+        with self.dir_lock:
+            if dir and not os.path.isdir(dir):
+                try:
+                    os.makedirs(dir,  0700)
+                except OSError as e:
+                    logging.error("Error {n} creating folder {f}: {s}".format(
+                        n=e.errno,
+                        f=dir.encode('utf-8'),
+                        s=e.strerror))
+
+    def export_cache_path(self, drive_file):
+        """Returns the path of the cached export of a document in the
+        current conversion format, and its mime type
+        """
+        (mime, extension, convert) = self.resolve_final_mime(drive_file)
+        return (os.path.join(self.exports_folder, drive_file.id + extension),
+                mime)
+
+    def cached_export(self, drive_file):
+        """Looks up the export of the current revision of a document in
+        the current conversion format.
+
+        Returns a (cache_path, md5) tuple or None if it's not cached"""
+        (cache_path, mime) = self.export_cache_path(drive_file)
+        row = self.manifest.get_export(drive_file.id, mime)
+        if row is None or row[0] != drive_file.modified_date:
+            return None
+        try:
+            st = os.stat(cache_path)
+        except OSError:
+            st = None
+        if st is None or stat_key(st) != row[2:]:
+            logging.debug("Cached export {f} is missing or modified".format(
+                        f=cache_path.encode('utf-8')))
+            self.manifest.forget_export(drive_file.id, mime)
+            return None
+        return (cache_path, row[1])
+
+    def restore_export(self, drive_file):
+        """Saves a document from the export cache instead of exporting it
+        again.
+
+        Returns True if the document was restored"""
+        export = self.cached_export(drive_file)
+        if export is None:
+            return False
+        (cache_path, md5) = export
+        file_path = self.get_path(drive_file)
+        logging.info("Reusing exported file: {f}".format(f=drive_file.title.encode('utf-8')))
+        self.make_dirs(os.path.dirname(file_path))
+        part_path = file_path + self.PARTIAL_SUFFIX
+        try:
+            if os.path.lexists(part_path):
+                os.remove(part_path)
+            link_or_copy(cache_path, part_path)
+            os.rename(part_path, file_path)
+            set_mtime(file_path, self.get_time(drive_file))
+            self.manifest.record(file_path, os.stat(file_path), md5,
+                                 drive_file.id)
+            self.manifest.update_export_stat(drive_file.id,
+                                             self.export_cache_path(drive_file)[1],
+                                             os.stat(cache_path))
+        except (IOError, OSError) as e:
+            logging.error("Error {n} restoring file {f}: {e}".format(
+                n=e.errno,
+                f=file_path.encode('utf-8'),
+                e=e.strerror))
+            return False
+        return True
+
+    def cache_export(self, drive_file, file_path, md5):
+        """Keeps a copy of an exported document in the export cache. The
+        cached exports of older revisions are removed.
+        """
+        (cache_path, mime) = self.export_cache_path(drive_file)
+        self.make_dirs(self.exports_folder)
+        try:
+            for (old_mime, modified_date) in self.manifest.get_exports(drive_file.id):
+                if modified_date != drive_file.modified_date:
+                    self.remove_export(drive_file.id, old_mime)
+            if os.path.lexists(cache_path):
+                os.remove(cache_path)
+            link_or_copy(file_path, cache_path)
+            st = os.stat(cache_path)
+        except (IOError, OSError) as e:
+            logging.error("Error {n} caching file {f}: {e}".format(
+                n=e.errno,
+                f=cache_path.encode('utf-8'),
                 e=e.strerror))
+            return
+        self.manifest.record_export(drive_file.id, mime,
+                                    drive_file.modified_date, md5, st)
+
+    def remove_export(self, file_id, mime):
+        """Removes a document from the export cache
+        """
+        cache_path = os.path.join(self.exports_folder,
+                                  file_id + self.MIME_EXTENSIONS[mime])
+        if os.path.lexists(cache_path):
+            os.remove(cache_path)
+        self.manifest.forget_export(file_id, mime)
+
+    def prune_exports(self):
+        """Removes from the export cache the documents no longer in Drive
+        """
+        for file_id in self.manifest.get_export_ids():
+            if self.tree.get(file_id) is None:
+                for (mime, modified_date) in self.manifest.get_exports(file_id):
+                    self.remove_export(file_id, mime)
 
     def backup_file(self, file_path):
-        """Move an existing file to BACKUP_FOLDER
+        """Move an existing file to BACKUP_FOLDER. If a backup with the
+        same content exists already, the new one is a hard link to it.
         """
-        if not os.path.isdir(self.BACKUP_FOLDER):
+        with self.metrics.timer('backup'):
+            self.move_to_backup(file_path)
+
+    def move_to_backup(self, file_path):
+        if not os.path.isdir(self.backup_folder):
             try:
-                os.makedirs(self.BACKUP_FOLDER,  0700)
+                os.makedirs(self.backup_folder,  0700)
             except OSError as e:
                 logging.error("Error {n} creating folder {f}: {s}".format(
                     n=e.errno,
-                    f=self.BACKUP_FOLDER.encode('utf-8'),
+                    f=self.backup_folder.encode('utf-8'),
                     s=e.strerror))
         backup_date = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
-        dst_path = os.path.join(self.BACKUP_FOLDER, backup_date + "-" + os.path.basename(file_path))
+        dst_path = os.path.join(self.backup_folder, backup_date + "-" + os.path.basename(file_path))
         logging.info("Making backup of {s} in {d}".format(
                 s=file_path.encode('utf-8'),
                 d=dst_path.encode('utf-8')))
         try:
-            shutil.move(file_path, dst_path)
+            st = os.stat(file_path)
+            md5 = self.manifest.lookup(file_path, st) or self.hash_file(file_path)
+            source = None
+            if md5 is not None:
+                source = self.find_backup(md5, st.st_size)
+            if source is not None:
+                try:
+                    os.link(source, dst_path)
+                    os.remove(file_path)
+                    logging.debug("Backup {d} deduplicated with {s}".format(
+                            d=dst_path.encode('utf-8'),
+                            s=source.encode('utf-8')))
+                except OSError:
+                    source = None
+            if source is None:
+                shutil.move(file_path, dst_path)
+                if md5 is not None:
+                    self.manifest.record_backup(dst_path, os.stat(dst_path), md5)
+            self.manifest.forget(file_path)
             logging.debug("File {f} deleted".format(f=file_path.encode('utf-8')))
-        except IOError as e:
+        except (IOError, OSError) as e:
             logging.error("Error {n} moving file {src} to {dst}: {e}".format(
                 n=e.errno,
                 src=file_path.encode('utf-8'),
@@ -276,58 +799,372 @@ class Drive(object):
                 e=e.strerror))
 
 
-    def download_all(self):
-        """Downloads all the files
+    def sync(self):
+        """Lists the Drive files and syncs them while the pages arrive,
+        see SyncPipeline.
+
+        Returns the SyncPlan carried out"""
+        scan = self.scan or self.start_scan()
+        self.scan = None
+        try:
+            with self.metrics.timer('sync'):
+                pipeline = SyncPipeline(self, scan)
+                complete = self.get_filelist(pipeline.add_page)
+                if not pipeline.pages:
+                    # The list wasn't retrieved page by page (incremental mode)
+                    pipeline.add_page(self.tree.files.values())
+                return self.finish_sync(pipeline, complete)
+        finally:
+            scan.close()
+
+    def sync_changes(self, local_paths=None):
+        """Syncs what changed since the last sync, keeping its file tree:
+        the files in the Drive changes list, the ones whose download
+        failed and the local paths given, which were modified in the
+        working dir. If local_paths is None, the whole local tree is
+        walked and compared.
+
+        Returns the SyncPlan carried out or None if the changes couldn't
+        be retrieved"""
+        change_token = self.manifest.get_state('change_token')
+        changed = {}
+        if change_token is None or not self.apply_changes(change_token, changed):
+            return None
+        if local_paths is None:
+            scan = self.start_scan()
+            pipeline = SyncPipeline(self, scan)
+            drive_files = self.tree.files.values()
+        else:
+            remote = dict(self.remote)
+            targets = set(changed) | self.failed
+            dirty = set(os.path.normpath(p) for p in local_paths)
+            dirty.update(os.path.normpath(self.local_path(p))
+                         for p in changed.itervalues() if p is not None)
+            folders = []
+            for file_path in dirty:
+                entry = remote.get(file_path)
+                if entry is not None:
+                    targets.add(entry.drive_file.id)
+                elif os.path.isdir(file_path) or not (
+                        os.path.lexists(file_path) or
+                        file_path.endswith(self.PARTIAL_SUFFIX) or
+                        file_path.endswith(self.SIDECAR_SUFFIX)):
+                    folders.append(file_path + os.sep)
+            if folders:
+                # Folders created, moved or removed
+                folders = tuple(folders)
+                for (file_path, entry) in remote.iteritems():
+                    if file_path.startswith(folders):
+                        targets.add(entry.drive_file.id)
+            if not targets and not dirty:
+                logging.debug("Nothing changed")
+                return SyncPlan()
+            # The files to plan again leave the paths they had
+            for file_id in targets:
+                file_path = changed.get(file_id) or self.tree.paths.get(file_id)
+                if file_path is None:
+                    continue
+                file_path = os.path.normpath(self.local_path(file_path))
+                entry = remote.get(file_path)
+                if entry is not None and entry.drive_file.id == file_id:
+                    del remote[file_path]
+            scan = self.start_scan(sorted(dirty))
+            pipeline = SyncPipeline(self, scan, remote)
+            drive_files = [self.tree.get(file_id) for file_id in targets
+                           if self.tree.get(file_id) is not None]
+        self.scan = None
+        try:
+            with self.metrics.timer('sync_changes'):
+                pipeline.add_page(drive_files)
+                return self.finish_sync(pipeline, True)
+        finally:
+            scan.close()
+
+    def finish_sync(self, pipeline, complete):
+        """Waits for a SyncPipeline to finish and keeps what the next
+        sync_changes needs
+
+        Returns the SyncPlan carried out"""
+        self.plan = pipeline.finish(complete)
+        self.remote = pipeline.remote
+        self.failed = pipeline.failed()
+        for name in ('keep', 'download', 'backup', 'fix_mtime', 'discard'):
+            self.metrics.count('plan_' + name, len(getattr(self.plan, name)))
+        return self.plan
+
+    def serve(self, interval):
+        """Syncs every interval seconds until interrupted, keeping the file
+        tree, the manifest and the connections in memory. After the first
+        sync, only the changes are synced. The local changes are watched
+        with inotify if pyinotify is available, otherwise the local tree
+        is walked every time. A sync which fails is logged and followed by
+        a full one. Another thread can end it with stop.
+        """
+        if self.pool is None:
+            # Fork the hashing processes before starting the watcher
+            self.start_scan()
+        watcher = None
+        if pyinotify is not None:
+            watcher = LocalWatcher(self)
+        else:
+            logging.warning("pyinotify not found, the local tree will be walked on every sync")
+        full = True
+        try:
+            while True:
+                local_paths = None
+                if watcher is not None:
+                    local_paths = watcher.changes()
+                try:
+                    if full:
+                        self.sync()
+                    elif self.sync_changes(local_paths) is None:
+                        logging.warning("Unable to retrieve the changes, syncing all the files")
+                        self.sync()
+                    full = False
+                except Exception:
+                    logging.exception("Error syncing, all the files will be synced next time")
+                    full = True
+                self.metrics.save()
+                if self.stopping.wait(interval):
+                    break
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def stop(self):
+        """Ends serve after the sync in progress"""
+        self.stopping.set()
+
+    def save_results(self, results):
+        """Records in the manifest the files saved by a Downloader
         """
-        for drive_file in self.drive_files:
-            if drive_file['mimeType'] not in self.IGNORE_MIMETYPES:
-                if not self.isTrashed(drive_file):
-                    if not self.file_exists_in_local(drive_file):
-                        file_path = self.get_path(drive_file)
-                        mtime = self.get_time(drive_file)
-                        content = self.download_file(drive_file)
-                        if content is not None:
-                            self.save_file(content, file_path, mtime)
+        for (drive_file, file_path, md5) in results:
+            try:
+                st = os.stat(file_path)
+            except OSError as e:
+                # Removed meanwhile, it's synced again next time
+                logging.error("Error {n} reading file {f}: {e}".format(
+                    n=e.errno,
+                    f=file_path.encode('utf-8'),
+                    e=e.strerror))
+                continue
+            self.manifest.record(file_path, st, md5, drive_file.id)
+            if self.resolve_final_mime(drive_file)[2]:
+                self.cache_export(drive_file, file_path, md5)
 
-    def file_exists_in_local(self, drive_file):
-        """Checks if a Drive file exists in our local tree.
-        This function can modify the local file to match Drive's mtime
+    def find_local_copy(self, md5, size):
+        """Looks for a local file, in the tree or in the backups, with the
+        given content. Only the files which didn't change since they were
+        recorded in the manifest are considered.
 
-        Returns True or False"""
+        Returns its path or None"""
+        for (file_path, inode, file_size, mtime_ns) in \
+                self.manifest.find_copies(md5, size):
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            if stat_key(st) == (inode, file_size, mtime_ns):
+                return file_path
+        return self.find_backup(md5, size)
+
+    def find_backup(self, md5, size):
+        """Looks for a backup with the given content.
+
+        Returns its path or None"""
+        for file_path in self.manifest.find_backups(md5, size):
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                st = None
+            if st is not None and st.st_size == size:
+                return file_path
+            self.manifest.forget_backup(file_path)
+        return None
+
+    def copy_local(self, drive_file):
+        """Saves a file by copying a local file with the same content
+        instead of downloading it. The copy is a reflink when the file
+        system supports it.
+
+        Returns True if the file was copied"""
+        key = content_key(drive_file)
+        if key is None:
+            return False
+        source = self.find_local_copy(*key)
+        if source is None:
+            return False
         file_path = self.get_path(drive_file)
-        drive_mtime = self.get_time(drive_file)
-        if os.path.isfile(file_path):
-            (md5_ok, mtime_ok) = files_match(file_path, drive_mtime,
-                                             drive_file['md5Checksum'])
-            if md5_ok:
-                if not mtime_ok:
-                    logging.warning("Local file {f} mtime doesn't match with remote mtime: {f}".format(
-                            f=file_path.encode('utf-8')))
-                    set_mtime(file_path, drive_mtime)
-                    return True
-                else:
-                    return True
-            else:
-                logging.warning("Local file {f} md5 doesn't match with remote md5".format(
-                        f=file_path.encode('utf-8')))
+        logging.info("Copying file {f} from {s}".format(
+                f=drive_file.title.encode('utf-8'),
+                s=source.encode('utf-8')))
+        self.make_dirs(os.path.dirname(file_path))
+        part_path = file_path + self.PARTIAL_SUFFIX
+        try:
+            clone_file(source, part_path)
+            os.rename(part_path, file_path)
+            if os.path.lexists(part_path + self.SIDECAR_SUFFIX):
+                os.remove(part_path + self.SIDECAR_SUFFIX)
+            set_mtime(file_path, self.get_time(drive_file))
+            self.manifest.record(file_path, os.stat(file_path), key[0],
+                                 drive_file.id)
+            self.metrics.count('files_copied')
+        except (IOError, OSError) as e:
+            logging.error("Error {n} copying file {f}: {e}".format(
+                n=e.errno,
+                f=file_path.encode('utf-8'),
+                e=e.strerror))
+            if os.path.lexists(part_path):
+                os.remove(part_path)
+            return False
+        return True
+
+    def sync_file(self, drive_file, http=None):
+        """Downloads a file and saves it in its local path.
+
+        Returns a (drive_file, file_path, md5) tuple if the file was saved,
+        None otherwise"""
+        file_path = self.get_path(drive_file)
+        mtime = self.get_time(drive_file)
+        with self.metrics.timer('download'):
+            md5 = self.save_file(drive_file, file_path, mtime, http)
+        if md5 is not None:
+            self.metrics.count('files_downloaded')
+            return (drive_file, file_path, md5)
+        self.metrics.count('download_failures')
+        return None
+
+    def is_synced(self, drive_file):
+        """ Returns True if the file has to be downloaded
+        """
+        if drive_file.mime_type in self.IGNORE_MIMETYPES:
+            return False
+        if not self.filter.accepts(drive_file):
+            return False
+        return not self.isTrashed(drive_file)
+
+    def in_scope(self, drive_file):
+        """ Returns True if the path rules select a file by its place in
+        Drive. The files whose folder isn't in the file tree are outside
+        the folders listed.
+        """
+        if not self.filter.path_rules:
+            return True
+        if drive_file.parent_is_root:
+            folder_path = u''
+        else:
+            parent = self.tree.get(drive_file.parent_id)
+            if parent is None:
                 return False
+            folder_path = self.tree.get_path(parent)
+        return self.filter.accepts_path(
+            os.path.normpath(os.path.join(folder_path, drive_file.title)),
+            drive_file.mime_type == self.FOLDER_MIMETYPE)
 
+    def selects(self, drive_file):
+        """ Returns True if the rules select a file or folder
+        """
+        return self.filter.accepts(drive_file) and self.in_scope(drive_file)
 
-    def file_exists_in_drive(self, file_path):
-        """Check if a local file exits in Drive
+    def is_excluded(self, path, is_folder=False):
+        """ Returns True if the path rules leave out a local path
+        """
+        return not self.filter.accepts_path(self.relative_path(path), is_folder)
 
-        Returns True or False"""
-        md5 = md5_for_file(file_path)
-        exists = False
-        for f in self.drive_files:
-            if f.get('md5Checksum') == md5 and \
-                    os.path.abspath(self.get_path(f)) == os.path.abspath(file_path):
-                exists = True
-        return exists
+    def remote_entry(self, drive_file):
+        """ Returns the RemoteEntry to compare a file with its local copy
+        """
+        return RemoteEntry(drive_file.md5, drive_file.size,
+                           time.mktime(self.get_time(drive_file)),
+                           drive_file)
+
+    def start_scan(self, paths=None):
+        """Starts walking the local tree in the background, so it can
+        overlap with the listing, or only the paths given. In verify mode
+        the files are hashed as they are found.
+        """
+        if self.pool is None:
+            # Fork the pool before starting any thread
+            self.pool = multiprocessing.Pool(self.hash_jobs)
+        self.scan = LocalScan(self, self.pool, self.verify, paths)
+        return self.scan
+
+    def compare_local(self, plan, file_path, st, entry):
+        """Compares a local file with its Drive counterpart and adds it
+        to the plan
+
+        Returns False if the MD5 of the local file is needed to decide,
+        True otherwise"""
+        md5 = None
+        if not self.verify:
+            md5 = self.manifest.lookup(file_path, st)
+        if entry.md5 is None:
+            # Converted documents don't have checksum nor size, compare
+            # with the export of their current revision in the current
+            # format instead
+            if md5 is None and self.cached_export(entry.drive_file) is not None:
+                return False
+        elif st.st_size == entry.size and md5 is None:
+            if st.st_mtime == entry.mtime and not self.verify:
+                # Same size and mtime as on Drive, trust it
+                md5 = entry.md5
+                self.manifest.record(file_path, st, md5,
+                                     entry.drive_file.id)
+            else:
+                return False
+        self.compare_hashed(plan, file_path, st, entry, md5)
+        return True
+
+    def compare_hashed(self, plan, file_path, st, entry, md5):
+        """Adds a local file to the plan once its MD5 is known, or None if
+        it's unknown
+        """
+        mtime_ok = st.st_mtime == entry.mtime
+        if entry.md5 is None:
+            file_id = entry.drive_file.id
+            export = self.cached_export(entry.drive_file)
+            if export is not None and md5 == export[1]:
+                if not mtime_ok:
+                    plan.fix_mtime.append((file_path, entry.mtime))
+                plan.keep.append(file_path)
+                return
+            if (md5 is not None and self.manifest.is_export(file_id, md5)) or \
+                    (mtime_ok and not self.manifest.get_exports(file_id)):
+                # Our own export of another revision or format
+                plan.download.append(entry.drive_file)
+                return
+        elif md5 == entry.md5:
+            if not mtime_ok:
+                logging.warning("Local file {f} mtime doesn't match with remote mtime".format(
+                        f=file_path.encode('utf-8')))
+                plan.fix_mtime.append((file_path, entry.mtime))
+            plan.keep.append(file_path)
+            return
+        logging.warning("Local file {f} doesn't match with remote file".format(
+                f=file_path.encode('utf-8')))
+        plan.backup.append(file_path)
+        plan.download.append(entry.drive_file)
+
+    def hash_file(self, file_path):
+        """Returns the MD5 of a local file or None if it can't be read
+        """
+        logging.debug("Hashing file {f}".format(f=file_path.encode('utf-8')))
+        try:
+            with self.metrics.timer('hash'):
+                md5 = md5_for_file(file_path)
+            self.metrics.count('hash_bytes', os.path.getsize(file_path))
+            return md5
+        except (IOError, OSError) as e:
+            logging.error("Error {n} reading file {f}: {e}".format(
+                n=e.errno,
+                f=file_path.encode('utf-8'),
+                e=e.strerror))
+            return None
 
     def is_system_file(self, file):
         """Returns true if it is a system file, otherwise, false"""
-        sysfiles = [ self.OAUTH2_STORAGE, u'.directory' ]
+        sysfiles = [ self.OAUTH2_STORAGE, self.MANIFEST,
+                     self.MANIFEST + u'-journal', u'.directory' ]
         for f in sysfiles:
             if file == f:
                 return True
@@ -335,28 +1172,53 @@ class Drive(object):
 
     def is_system_dir(self, dir):
         """Returns true if it is a system dir, otherwise, false"""
-        sysdirs = [ self.TRASH_FOLDER, self.BACKUP_FOLDER ]
+        sysdirs = [ self.trash_folder, self.backup_folder, self.exports_folder ]
         for d in sysdirs:
             if dir == d:
                 return True
         return False
 
-    def clean_local_tree(self):
-        """Remove local files not present on Drive"""
-        for root, dirs, files in os.walk(u'.'):
-            if self.is_system_dir(root):
-                continue
-            for f in files:
-                file_path=os.path.join(root, f)
-                if root == u'.' and self.is_system_file(f):
-                    continue
-                if self.file_exists_in_drive(file_path):
+    def is_partial(self, file_path):
+        """Returns True if a local file is a partial download left by a
+        previous run or its sidecar: the partial file and a readable
+        sidecar must be side by side"""
+        if file_path.endswith(self.PARTIAL_SUFFIX + self.SIDECAR_SUFFIX):
+            part_path = file_path[:-len(self.SIDECAR_SUFFIX)]
+        elif file_path.endswith(self.PARTIAL_SUFFIX):
+            part_path = file_path
+        else:
+            return False
+        if not os.path.isfile(part_path):
+            return False
+        try:
+            with open(part_path + self.SIDECAR_SUFFIX) as fh:
+                sidecar = json.load(fh)
+        except (IOError, ValueError):
+            return False
+        return isinstance(sidecar, dict) and 'signature' in sidecar
+
+    def discard_partial(self, file_path):
+        """Removes a partial download which can't be resumed"""
+        logging.debug("Removing stale partial download {f}".format(
+                    f=file_path.encode('utf-8')))
+        try:
+            os.remove(file_path)
+        except OSError as e:
+            logging.error("Error {n} removing file {f}: {e}".format(
+                n=e.errno,
+                f=file_path.encode('utf-8'),
+                e=e.strerror))
+
+    def remove_empty_dirs(self):
+        """Removes the folders left empty in the local tree"""
+        for root, dirs, files in os.walk(self.root):
+            for d in list(dirs):
+                if root == self.root and self.is_system_dir(os.path.join(root, d)):
                     continue
-                else:
-                    self.backup_file(file_path)
-        for root, dirs, files in os.walk(u'.'):
-            for d in dirs:
-                if root == u'.' and self.is_system_dir(d):
+                if self.filter.path_rules and \
+                        self.is_excluded(os.path.join(root, d), True):
+                    # Not ours
+                    dirs.remove(d)
                     continue
                 try:
                     logging.debug("Removing unused directory {d}".format(
@@ -367,108 +1229,2466 @@ class Drive(object):
 
 
 
-def set_mtime(file_path, mtime):
-    """Sets the modification time of a file
+class FileTree(object):
+    """ Index of the Drive files, built while they are listed.
+    It maps every file ID to its resource, keeps the parent/children
+    relations and memoizes the resolved paths, so looking up a file or
+    its path doesn't need to scan the whole list.
     """
-    try:
-        os.utime(file_path, (time.mktime(mtime), time.mktime(mtime)))
-    except OSError as e:
-        logging.error("Error {n} updating the mtime of the file {f}: {e}".format(
-            n=e.errno,
-            f=e.filename.encode('utf-8'),
-            e=e.strerror))
 
+    def __init__(self, drive):
+        self.drive = drive
+        self.files = {}
+        self.parent = {}
+        self.children = {}
+        self.paths = {}
 
-def md5_for_file(file_path):
-    with open(file_path, 'rb') as fh:
-        m = hashlib.md5()
-        while True:
-            data = fh.read(8192)
-            if not data:
-                break
-            m.update(data)
-        return m.hexdigest()
+    def build(self, drive_files):
+        """ Indexes a list of DriveFile, replacing the current content
+        """
+        self.files.clear()
+        self.parent.clear()
+        self.children.clear()
+        self.paths.clear()
+        for drive_file in drive_files:
+            self.add(drive_file)
 
+    def get(self, file_id):
+        """ Returns the DriveFile with the given ID or None
+        """
+        return self.files.get(file_id)
 
-def files_match(file_path, mtime, md5sum):
-    """Checks a file to see if it matches the provided
-    md5sum and modification time.
-    
-    Returns:
-     a tuple of booleans:
-     (match_md5, match_mtime)
-    """
-    try:
-        md5 = md5_for_file(file_path)
-    except IOError as e:
-        logging.error("Error {n} reading file {f}: {e}".format(
-            n=e.errno,
-            f=e.filename.encode('utf-8'),
-            e=e.strerror))
-        return False
-    if md5 == md5sum:
-        match_md5 = True
-    else:
-        match_md5 = False
-    if os.path.getmtime(file_path) == time.mktime(mtime):
-        match_mtime = True
-    else:
-        match_mtime = False
-    return (match_md5, match_mtime)
+    def add(self, drive_file):
+        """ Adds or replaces a DriveFile in the index. If the file was
+        renamed or moved, the cached paths of it and all its descendants
+        are invalidated.
+        """
+        file_id = drive_file.id
+        parent_id = drive_file.parent_id
+        old_file = self.files.get(file_id)
+        if old_file is not None:
+            if path_key(old_file) != path_key(drive_file):
+                logging.debug("Drive file {f} renamed or moved".format(
+                        f=drive_file.title.encode('utf-8')))
+                self.invalidate(file_id)
+            old_parent_id = self.parent.get(file_id)
+            if old_parent_id != parent_id:
+                self.children.get(old_parent_id, set()).discard(file_id)
+        self.files[file_id] = drive_file
+        self.parent[file_id] = parent_id
+        self.children.setdefault(parent_id, set()).add(file_id)
 
+    def remove(self, file_id):
+        """ Removes a file from the index, invalidating the cached paths
+        of its descendants
+        """
+        if file_id not in self.files:
+            return
+        self.invalidate(file_id)
+        del self.files[file_id]
+        parent_id = self.parent.pop(file_id)
+        self.children.get(parent_id, set()).discard(file_id)
 
-def main(argv):
-    base_lockfile = os.path.join('/var/run/user', str(os.getuid()))
-    if not os.path.isdir(base_lockfile):
-        base_lockfile = '/tmp'
-    lockfile = os.path.join(base_lockfile, '.drive-downloader')
-    opendocument_conv = {u'application/vnd.google-apps.document': u'application/vnd.oasis.opendocument.text',
-                         u'application/vnd.google-apps.spreadsheet': u'application/x-vnd.oasis.opendocument.spreadsheet',
-                         u'application/vnd.google-apps.drawing': u'image/svg+xml',
-                         u'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
-                         }
-
-    pdf_conv = {u'application/vnd.google-apps.document': u'application/pdf',
-                u'application/vnd.google-apps.spreadsheet': u'application/pdf',
-                u'application/vnd.google-apps.drawing': u'application/pdf',
-                u'application/vnd.google-apps.presentation': u'application/pdf'
-                }
+    def invalidate(self, file_id):
+        """ Forgets the cached path of a file and all its descendants
+        """
+        pending = [file_id]
+        while pending:
+            current = pending.pop()
+            self.paths.pop(current, None)
+            pending.extend(self.children.get(current, ()))
 
-    client_secrets_default = os.path.join(os.path.abspath(os.path.dirname(__file__)),
-                                          "client_secrets.json")
-    client_secrets_help = """JSON file with your Google Drive API credentials.
-    https://developers.google.com/drive/web/about-auth
-    (default: client_secrets.json)"""
-    
-    working_dir_default = os.getcwd()
-    working_dir_help = """Root directory to download your Drive content.
-    (default: the current directory)"""
+    def subtree(self, file_id):
+        """ Returns the IDs of a file and all its descendants
+        """
+        file_ids = []
+        pending = [file_id]
+        while pending:
+            current = pending.pop()
+            file_ids.append(current)
+            pending.extend(self.children.get(current, ()))
+        return file_ids
 
-    convert_choices = ["opendocument", "pdf"]
-    convert_default = "opendocument"
-    convert_help = """Which format convert the Google documents to (opendocument|pdf)
-    (default: opendocument)"""
+    def cached_paths(self, file_id):
+        """ Returns a dictionary with the cached paths of a file and all
+        its descendants by ID
+        """
+        paths = {}
+        pending = [file_id]
+        while pending:
+            current = pending.pop()
+            if current in self.paths:
+                paths[current] = self.paths[current]
+            pending.extend(self.children.get(current, ()))
+        return paths
 
-    loglevel_choices = ["debug", "info", "warning", "error", "critical"]
-    loglevel_default = "info"
-    loglevel_help = """Verbosity level"""
+    def missing_ancestor(self, drive_file):
+        """ Returns the ID of the first folder above a file which isn't
+        in the index yet, or None if its path can be resolved already
+        """
+        while drive_file.id not in self.paths:
+            if drive_file.trashed or drive_file.parent_is_root or \
+                    drive_file.parent_id is None:
+                return None
+            parent = self.get(drive_file.parent_id)
+            if parent is None:
+                return drive_file.parent_id
+            drive_file = parent
+        return None
 
-    program_description = """Drive downloader is a program to download the
-    contents of your Google Drive account."""
-    
-    parser = argparse.ArgumentParser()
-    parser = argparse.ArgumentParser(description=program_description)
-    parser.add_argument("-w", "--working-dir", help=working_dir_help,
-                        default=working_dir_default)
+    def get_path(self, drive_file):
+        """ Returns the path of a file, with the name of the file included
+        """
+        file_id = drive_file.id
+        file_path = self.paths.get(file_id)
+        if file_path is None:
+            # Only the paths not resolved yet are timed, the cached ones
+            # are the common case and must stay cheap
+            with self.drive.metrics.timer('resolve_path'):
+                file_path = self.resolve_path(drive_file)
+            self.paths[file_id] = file_path
+            self.drive.metrics.count('paths_resolved')
+        return file_path
+
+    def resolve_path(self, drive_file):
+        """ Computes the path of a file from the path of its parent
+        """
+        drive = self.drive
+        if drive.isTrashed(drive_file):
+            file_path = os.path.join(drive.TRASH_FOLDER, drive_file.title)
+        elif drive.parentIsRoot(drive_file):
+            file_path = drive_file.title
+        elif drive_file.parent_id is not None:
+            parent = self.get(drive_file.parent_id)
+            if parent is None:
+                # The parent is not visible to us (i.e. a file shared
+                # from a folder we can't access), keep it in the root.
+                file_path = drive_file.title
+            else:
+                file_path = os.path.join(self.get_path(parent), drive_file.title)
+        elif drive_file.mime_type in drive.conversion.keys():
+            (mime, extension, convert) = drive.resolve_final_mime(drive_file)
+            file_path = drive_file.title + extension
+        else:
+            file_path = drive_file.title
+        return file_path
+
+
+
+class LocalScan(object):
+    """ Walks the local tree, or only some paths of it, in a background
+    thread, keeping the stat of every file found, and hashes files in a
+    pool of processes. If hash_all is True, every file is hashed as soon
+    as it's found, otherwise only the ones submitted. The hashes are
+    handed back in the order they finish.
+    """
+
+    def __init__(self, drive, pool, hash_all, paths=None):
+        self.drive = drive
+        self.pool = pool
+        self.hash_all = hash_all
+        self.paths = paths
+        self.files = []
+        self.submitted = set()
+        self.received = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.results = Queue.Queue()
+        self.thread = threading.Thread(target=self.walk,
+                                       name=drive.thread_name("LocalScan"))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def walk(self):
+        drive = self.drive
+        is_excluded = None
+        if drive.filter.path_rules:
+            is_excluded = drive.is_excluded
+        if self.paths is None:
+            found = scan_tree(drive.root, drive.is_system_dir, drive.is_system_file,
+                              is_excluded)
+        else:
+            found = scan_paths(self.paths, is_excluded)
+        for (file_path, st) in found:
+            if self.stopped:
+                break
+            self.files.append((file_path, st))
+            if self.hash_all:
+                self.submit(file_path)
+
+    def wait(self):
+        """ Waits for the walk to finish and returns a list of
+        (file_path, stat) tuples
+        """
+        while self.thread.is_alive():
+            self.thread.join(1)
+        return self.files
+
+    def submit(self, file_path):
+        """ Queues a file to be hashed, if it wasn't already
+        """
+        file_path = os.path.normpath(file_path)
+        with self.lock:
+            if file_path in self.submitted:
+                return
+            self.submitted.add(file_path)
+        self.pool.apply_async(hash_job, (file_path,),
+                              callback=self.results.put)
+
+    def hashes(self, block=True):
+        """ Yields (file_path, md5) tuples as the files are hashed, md5 is
+        None if the file couldn't be read. If block is False, only the
+        ones already hashed are yielded, otherwise it waits for all the
+        files submitted.
+        """
+        metrics = self.drive.metrics
+        while self.received < len(self.submitted):
+            try:
+                # Waiting with a timeout lets KeyboardInterrupt through
+                (file_path, md5, size, seconds) = self.results.get(block, 1)
+            except Queue.Empty:
+                if block:
+                    continue
+                return
+            self.received += 1
+            metrics.observe('hash', seconds)
+            metrics.count('hash_bytes', size)
+            yield (file_path, md5)
+
+    def close(self):
+        """ Stops the walk. The files submitted are still hashed, the pool
+        is shared with the next scans.
+        """
+        self.stopped = True
+
+
+class LocalWatcher(object):
+    """ Watches the working dir with inotify and collects the paths
+    created, written, moved or removed in it, so the local tree doesn't
+    need to be walked to find the changes. If the kernel drops events,
+    the changes are unknown until the next call to changes.
+    """
+    def __init__(self, drive):
+        self.drive = drive
+        self.paths = set()
+        self.overflow = False
+        self.lock = threading.Lock()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO)
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(self.manager, self.handle)
+        self.notifier.name = drive.thread_name("LocalWatcher")
+        self.notifier.daemon = True
+        self.notifier.start()
+        self.top = os.path.abspath(drive.root)
+        self.manager.add_watch(self.top, mask, rec=True, auto_add=True,
+                               exclude_filter=self.excluded)
+
+    def relpath(self, path):
+        if isinstance(path, str):
+            path = path.decode(sys.getfilesystemencoding())
+        return os.path.relpath(path, self.top)
+
+    def excluded(self, path):
+        """ Returns True for the system folders and the ones excluded by
+        the path rules, which aren't watched
+        """
+        path = self.drive.local_path(os.path.join(u'.', self.relpath(path)))
+        if self.drive.filter.path_rules and self.drive.is_excluded(path, True):
+            return True
+        return self.drive.is_system_dir(path)
+
+    def handle(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            logging.warning("Too many local changes, the local tree will be walked")
+            with self.lock:
+                self.overflow = True
+            return
+        file_path = self.relpath(event.pathname)
+        if os.path.dirname(file_path) == u'':
+            if self.drive.is_system_file(file_path) or \
+                    self.drive.is_system_dir(self.drive.local_path(
+                        os.path.join(u'.', file_path))):
+                return
+        file_path = self.drive.local_path(file_path)
+        if self.drive.filter.path_rules and \
+                self.drive.is_excluded(file_path, event.dir):
+            return
+        with self.lock:
+            self.paths.add(file_path)
+
+    def changes(self):
+        """ Returns the paths changed since the last call, or None if they
+        are unknown
+        """
+        with self.lock:
+            (paths, self.paths) = (self.paths, set())
+            overflow = self.overflow
+            self.overflow = False
+        if overflow:
+            return None
+        return paths
+
+    def close(self):
+        self.notifier.stop()
+
+
+class Metrics(object):
+    """ Counters and timings of a run, updated by all the threads. Every
+    timing keeps the number of times it was observed, its total and its
+    maximum. They can be saved as JSON or in the Prometheus text format,
+    to be collected by the textfile collector of the node exporter, with
+    the labels given, like the account of a Drive synced with others.
+    """
+    PREFIX = 'drive_downloader_'
+
+    def __init__(self, path=None, labels=None):
+        self.path = path
+        self.labels = labels or {}
+        self.started = time.time()
+        self.counters = collections.Counter()
+        # Name -> [count, total seconds, max seconds]
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """ Times the block of a with statement
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def to_dict(self):
+        with self.lock:
+            return {'labels': dict(self.labels),
+                    'elapsed_seconds': time.time() - self.started,
+                    'peak_memory_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                    'counters': dict(self.counters),
+                    'timings': dict((name, {'count': count,
+                                            'seconds': seconds,
+                                            'max_seconds': max_seconds})
+                                    for (name, (count, seconds, max_seconds))
+                                    in self.timings.iteritems())}
+
+    def summary(self):
+        """ Logs the timings and counters
+        """
+        values = self.to_dict()
+        logging.info("Summary of the run, {t:.1f} seconds:".format(t=values['elapsed_seconds']))
+        for (name, timing) in sorted(values['timings'].iteritems()):
+            logging.info("  {name}: {n} in {t:.2f} s, {a:.3f} s on average, {m:.3f} s max".format(
+                    name=name, n=timing['count'], t=timing['seconds'],
+                    a=timing['seconds'] / timing['count'], m=timing['max_seconds']))
+        for (name, value) in sorted(values['counters'].iteritems()):
+            logging.info("  {name}: {v}".format(name=name, v=value))
+        if values['counters'].get('download_bytes'):
+            logging.info("  download throughput: {r:.2f} MiB/s".format(
+                    r=values['counters']['download_bytes'] / 1048576.0 /
+                    values['elapsed_seconds']))
+
+    def prometheus(self, values):
+        """ Returns the metrics in the Prometheus text format
+        """
+        lines = []
+        labels = ''
+        if values['labels']:
+            labels = '{' + ','.join(
+                '{k}="{v}"'.format(k=key, v=value.encode('utf-8').replace('\\', '\\\\')
+                                   .replace('"', '\\"').replace('\n', '\\n'))
+                for (key, value) in sorted(values['labels'].iteritems())) + '}'
+
+        def metric(name, kind, value):
+            lines.append('# TYPE {p}{n} {k}'.format(p=self.PREFIX, n=name, k=kind))
+            lines.append('{p}{n}{l} {v!r}'.format(p=self.PREFIX, n=name, l=labels, v=value))
+
+        metric('last_run_timestamp_seconds', 'gauge', time.time())
+        metric('elapsed_seconds', 'gauge', values['elapsed_seconds'])
+        metric('peak_memory_bytes', 'gauge', values['peak_memory_bytes'])
+        for (name, value) in sorted(values['counters'].iteritems()):
+            metric(name + '_total', 'counter', value)
+        for (name, timing) in sorted(values['timings'].iteritems()):
+            lines.append('# TYPE {p}{n}_seconds summary'.format(p=self.PREFIX, n=name))
+            lines.append('{p}{n}_seconds_count{l} {v!r}'.format(
+                    p=self.PREFIX, n=name, l=labels, v=timing['count']))
+            lines.append('{p}{n}_seconds_sum{l} {v!r}'.format(
+                    p=self.PREFIX, n=name, l=labels, v=timing['seconds']))
+            metric(name + '_max_seconds', 'gauge', timing['max_seconds'])
+        return '\n'.join(lines) + '\n'
+
+    def save(self):
+        """ Writes the metrics to path, as JSON if its name ends with
+        .json, otherwise in the Prometheus text format. The file is
+        replaced at once, so it's never read half written.
+        """
+        if self.path is None:
+            return
+        values = self.to_dict()
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as fh:
+                if self.path.endswith('.json'):
+                    json.dump(values, fh, indent=2, sort_keys=True)
+                else:
+                    fh.write(self.prometheus(values))
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.error("Error {n} writing metrics file {f}: {e}".format(
+                n=e.errno,
+                f=self.path.encode('utf-8'),
+                e=e.strerror))
+
+
+class Sampler(object):
+    """ Sampling profiler of all the threads. Every INTERVAL seconds the
+    stack of every thread is recorded. On close, the stacks are written
+    in the collapsed format read by flamegraph.pl and speedscope: one
+    line per stack, with the number of times it was seen. Unlike
+    cProfile, it sees the worker threads, and its overhead doesn't grow
+    with the number of calls, so it can run in production.
+    """
+    INTERVAL = 0.005
+
+    def __init__(self, path):
+        self.path = path
+        self.stacks = collections.Counter()
+        self.labels = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name="Sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = '{f} ({m}:{l})'.format(f=code.co_name,
+                                           m=os.path.basename(code.co_filename),
+                                           l=code.co_firstlineno)
+            self.labels[code] = label
+        return label
+
+    def sample(self):
+        own = threading.current_thread().ident
+        while not self.stopped.wait(self.INTERVAL):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for (ident, frame) in sys._current_frames().iteritems():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'Thread'))
+                stack.reverse()
+                self.stacks[';'.join(stack)] += 1
+
+    def close(self):
+        """ Stops sampling and writes the stacks to path
+        """
+        self.stopped.set()
+        self.thread.join()
+        try:
+            with open(self.path, 'w') as fh:
+                for (stack, count) in sorted(self.stacks.iteritems()):
+                    fh.write('{s} {n}\n'.format(s=stack, n=count))
+            logging.info("Profile saved to {f}".format(f=self.path.encode('utf-8')))
+        except (IOError, OSError) as e:
+            logging.error("Error {n} writing profile {f}: {e}".format(
+                n=e.errno,
+                f=self.path.encode('utf-8'),
+                e=e.strerror))
+
+
+class RateLimiter(object):
+    """ Token bucket limiting the rate of requests of all the threads.
+    When the API reports that the rate limit was exceeded, it can be
+    paused for everybody.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.resume_at = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a request can be made
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now >= self.resume_at:
+                    if self.rate <= 0:
+                        return
+                    self.tokens = min(self.capacity,
+                                      self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.resume_at - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ Holds all the requests for the given number of seconds
+        """
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.time() + seconds)
+
+
+class BandwidthWindow(object):
+    """ A cap of the download bandwidth in bytes per second, 0 to pause
+    the downloads, from a time of the day to another on some days of
+    the week (0 is Monday). If it ends before it starts, it ends on the
+    next day.
+    """
+
+    def __init__(self, days, start, end, rate):
+        self.days = frozenset(days)
+        self.start = start
+        self.end = end
+        self.rate = rate
+
+    def applies(self, now):
+        """ Returns True if the window covers a time.struct_time
+        """
+        minute = now.tm_hour * 60 + now.tm_min
+        day = now.tm_wday
+        if self.start <= self.end:
+            inside = self.start <= minute < self.end
+        else:
+            inside = minute >= self.start or minute < self.end
+            if minute < self.end:
+                # It started on the day before
+                day = (day - 1) % 7
+        return inside and day in self.days
+
+
+class BandwidthLimiter(object):
+    """ Caps the bytes per second downloaded by all the threads, with a
+    global cap and caps for time windows, in local time. The workers
+    report the bytes of every chunk received and wait until the chunk
+    fits under the cap, and ask for chunks of about a second of transfer
+    so the link isn't saturated in bursts.
+    """
+    MIN_CHUNK_SIZE = 256 * 1024
+    PAUSE_CHECK_INTERVAL = 30
+
+    def __init__(self, rate=0, windows=()):
+        self.rate = rate
+        self.windows = list(windows)
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def current_rate(self):
+        """ Returns the cap in effect, or None if there isn't any
+        """
+        now = time.localtime()
+        rates = [window.rate for window in self.windows if window.applies(now)]
+        if self.rate:
+            rates.append(self.rate)
+        if not rates:
+            return None
+        return min(rates)
+
+    def chunk_size(self, default):
+        """ Returns the size of the next chunk to request
+        """
+        rate = self.current_rate()
+        if not rate:
+            return default
+        return min(default, max(self.MIN_CHUNK_SIZE, int(rate)))
+
+    def acquire(self):
+        """ Blocks while a window pauses the downloads
+        """
+        paused = False
+        while self.current_rate() == 0:
+            if not paused:
+                logging.info("Downloads paused by a bandwidth window")
+                paused = True
+            time.sleep(self.PAUSE_CHECK_INTERVAL)
+
+    def consume(self, size):
+        """ Records the bytes received and waits until they fit under the
+        cap. Returns the seconds waited.
+        """
+        rate = self.current_rate()
+        if not rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + float(size) / rate
+            wait = self.next_time - now
+        time.sleep(wait)
+        return wait
+
+
+class HttpPool(object):
+    """ Keeps the authorized httplib2.Http objects released by the threads,
+    with their connections open, to reuse them. A pool can be shared by
+    several Drives: the objects are kept by Drive, since they carry its
+    credentials, and if max_idle is given, beyond that many idle objects
+    the connections of the least recently released one are closed.
+    """
+
+    def __init__(self, max_idle=None):
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, owner):
+        """ Returns an idle object of owner, or None if there isn't any
+        """
+        with self.lock:
+            for n in range(len(self.idle) - 1, -1, -1):
+                if self.idle[n][0] is owner:
+                    return self.idle.pop(n)[1]
+        return None
+
+    def release(self, owner, http):
+        closed = None
+        with self.lock:
+            self.idle.append((owner, http))
+            if self.max_idle is not None and len(self.idle) > self.max_idle:
+                closed = self.idle.pop(0)[1]
+        if closed is not None:
+            for connection in closed.connections.values():
+                connection.close()
+
+
+class SharedResources(object):
+    """ What the Drives synced together in a process share: the hashing
+    processes, the idle connections, a budget of jobs download slots and
+    the bandwidth cap
+    """
+
+    def __init__(self, jobs, hash_jobs, bandwidth=0, bandwidth_windows=()):
+        # Fork the pool before starting any thread
+        self.pool = multiprocessing.Pool(hash_jobs)
+        self.https = HttpPool(2 * jobs)
+        self.download_slots = threading.BoundedSemaphore(jobs)
+        self.bandwidth = BandwidthLimiter(bandwidth, bandwidth_windows)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class RequestExecutor(object):
+    """ Runs the API requests through a shared RateLimiter. The ones which
+    fail because of rate limits, server or network errors are retried with
+    jittered exponential backoff, honoring the Retry-After header.
+    """
+    MAX_RETRIES = 7
+    MAX_BACKOFF = 64
+    RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+    RATE_LIMIT_REASONS = frozenset(['rateLimitExceeded', 'userRateLimitExceeded'])
+
+    def __init__(self, rate, metrics):
+        self.limiter = RateLimiter(rate)
+        self.metrics = metrics
+
+    def execute(self, request):
+        """ Executes a googleapiclient request and returns its result.
+        HttpError is raised if it can't be retried any more.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                with self.metrics.timer('api_request'):
+                    return request.execute()
+            except errors.HttpError, error:
+                if not self.should_retry(error.resp, error.content, attempt):
+                    raise
+                self.backoff(error.resp, error.content, attempt)
+            except NETWORK_ERRORS, error:
+                if attempt >= self.MAX_RETRIES:
+                    raise
+                logging.warning("Network error: {e}".format(e=error))
+                self.backoff(None, None, attempt)
+            attempt += 1
+
+    def request(self, http, uri, **kwargs):
+        """ Makes a request with an httplib2.Http object and returns the
+        (response, content) tuple of the last attempt.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                with self.metrics.timer('download_request'):
+                    resp, content = http.request(uri, **kwargs)
+                if not self.should_retry(resp, content, attempt):
+                    return (resp, content)
+                self.backoff(resp, content, attempt)
+            except NETWORK_ERRORS, error:
+                if attempt >= self.MAX_RETRIES:
+                    raise
+                logging.warning("Network error: {e}".format(e=error))
+                self.backoff(None, None, attempt)
+            attempt += 1
+
+    def should_retry(self, resp, content, attempt):
+        if attempt >= self.MAX_RETRIES:
+            return False
+        if resp.status in self.RETRY_STATUSES:
+            return True
+        return resp.status == 403 and self.rate_limited(content)
+
+    def rate_limited(self, content):
+        """ Returns True if an error response is about rate limits
+        """
+        try:
+            error = json.loads(content)['error']
+            reasons = set(e.get('reason') for e in error.get('errors', []))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return not reasons.isdisjoint(self.RATE_LIMIT_REASONS)
+
+    def backoff(self, resp, content, attempt):
+        """ Waits before the next attempt. If the rate limit was exceeded,
+        the requests of all the threads are held.
+        """
+        self.metrics.count('retries')
+        delay = min(self.MAX_BACKOFF, 2 ** attempt) + random.random()
+        if resp is not None:
+            retry_after = resp.get('retry-after', '')
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logging.warning("Request failed with status {s}, retrying in {d:.1f} seconds".format(
+                    s=resp.status, d=delay))
+            if resp.status == 429 or resp.status == 403:
+                self.limiter.pause(delay)
+        time.sleep(delay)
+
+
+class PartialFile(object):
+    """ An unfinished download, written to a .part file next to its
+    destination. A sidecar file records the Drive file it belongs to and
+    the offset written and synced to disk so far, so if the remote file
+    didn't change, the download can be resumed from that offset.
+    """
+
+    def __init__(self, part_path, sidecar_path, drive_file):
+        self.path = part_path
+        self.sidecar_path = sidecar_path
+        self.signature = {'id': drive_file.id,
+                          'fileSize': drive_file.size,
+                          'md5Checksum': drive_file.md5,
+                          'modifiedDate': drive_file.modified_date}
+        self.fh = None
+        self.md5 = hashlib.md5()
+        self.offset = 0
+
+    def open(self):
+        """ Opens the partial file, resuming it if possible. The part
+        already written is hashed again.
+        """
+        offset = self.saved_offset()
+        if offset and os.path.isfile(self.path) and \
+                os.path.getsize(self.path) >= offset:
+            logging.info("Resuming download of {f} at byte {n}".format(
+                    f=self.path.encode('utf-8'), n=offset))
+            self.fh = open(self.path, 'r+b')
+            self.fh.truncate(offset)
+            while self.offset < offset:
+                data = self.fh.read(min(1024 * 1024, offset - self.offset))
+                if not data:
+                    break
+                self.md5.update(data)
+                self.offset += len(data)
+        else:
+            self.fh = open(self.path, 'wb')
+
+    def saved_offset(self):
+        """ Returns the offset recorded in the sidecar if it belongs to the
+        same version of the file, otherwise 0
+        """
+        try:
+            with open(self.sidecar_path) as fh:
+                sidecar = json.load(fh)
+        except (IOError, ValueError):
+            return 0
+        if sidecar.get('signature') != self.signature:
+            logging.info("Remote file changed, discarding partial download {f}".format(
+                    f=self.path.encode('utf-8')))
+            return 0
+        return sidecar.get('offset', 0)
+
+    def write(self, data):
+        self.fh.write(data)
+        self.md5.update(data)
+        self.offset += len(data)
+
+    def checkpoint(self):
+        """ Syncs the data written to disk and records its offset
+        """
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        with open(self.sidecar_path, 'w') as fh:
+            json.dump({'signature': self.signature, 'offset': self.offset}, fh)
+
+    def reset(self):
+        """ Throws away the data written to start again
+        """
+        self.fh.seek(0)
+        self.fh.truncate()
+        self.md5 = hashlib.md5()
+        self.offset = 0
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def discard(self):
+        """ Closes and removes the partial file and its sidecar
+        """
+        self.close()
+        for path in (self.path, self.sidecar_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def complete(self, file_path):
+        """ Moves the finished file into file_path
+        """
+        self.close()
+        os.rename(self.path, file_path)
+        if os.path.isfile(self.sidecar_path):
+            os.remove(self.sidecar_path)
+
+
+class DownloadQueue(object):
+    """ Files waiting to be downloaded, smallest first, so most of the
+    files are synced early. The files over LARGE_FILE_SIZE wait in their
+    own lane, served by their own workers, so they don't hold up the
+    small ones. The documents to export, whose size is unknown, count as
+    small.
+    """
+    LARGE_FILE_SIZE = 64 * 1024 * 1024
+    # Lanes served by a worker
+    SMALL = 'small'
+    LARGE = 'large'
+    ANY = 'any'
+
+    def __init__(self):
+        self.small = []
+        self.large = []
+        self.serial = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, drive_file):
+        size = drive_file.size or 0
+        with self.condition:
+            lane = self.large if size > self.LARGE_FILE_SIZE else self.small
+            # The serial keeps the listing order between files of the
+            # same size
+            heapq.heappush(lane, (size, self.serial, drive_file))
+            self.serial += 1
+            self.condition.notify_all()
+
+    def get(self, lane):
+        """ Returns the next file for a worker of a lane: SMALL workers
+        only take small files, LARGE workers take large files first and
+        then small ones, ANY workers take the smallest file of both.
+        Blocks until there is one, returns None once the queue is closed
+        and empty.
+        """
+        with self.condition:
+            while True:
+                if lane == self.LARGE and self.large:
+                    return heapq.heappop(self.large)[2]
+                if self.small:
+                    return heapq.heappop(self.small)[2]
+                if lane != self.SMALL and self.large:
+                    return heapq.heappop(self.large)[2]
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+    def close(self):
+        """ Lets the workers finish once the queue is empty
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class Downloader(object):
+    """ Pool of worker threads which download the files submitted to it
+    while they are started, in the order of a DownloadQueue. With
+    several jobs, a quarter of the workers (at least one) serve the lane
+    of the large files. Every worker borrows an authorized
+    httplib2.Http object from the Drive for the run, the results are handed back to the calling
+    thread, which is the only one touching the manifest. A file is only
+    downloaded while holding one of the download slots of the Drive,
+    which can be shared with other Drives. The progress is
+    logged every PROGRESS_INTERVAL seconds, with an estimate of the time
+    left from the throughput of the last THROUGHPUT_WINDOW seconds.
+    """
+    PROGRESS_INTERVAL = 30
+    THROUGHPUT_WINDOW = 60
+
+    def __init__(self, drive, jobs):
+        self.drive = drive
+        self.jobs = max(1, jobs)
+        self.queue = DownloadQueue()
+        self.results = Queue.Queue()
+        self.workers = []
+        self.running = 0
+        self.total_bytes = 0
+        self.baseline = drive.metrics.counters['download_bytes']
+        self.samples = collections.deque()
+        self.reported = time.time()
+
+    def start(self):
+        if self.jobs == 1:
+            lanes = [DownloadQueue.ANY]
+        else:
+            large_jobs = max(1, self.jobs // 4)
+            lanes = [DownloadQueue.LARGE] * large_jobs + \
+                [DownloadQueue.SMALL] * (self.jobs - large_jobs)
+        for (n, lane) in enumerate(lanes):
+            worker = threading.Thread(target=self.work, args=(lane,),
+                                      name=self.drive.thread_name(
+                                          "Downloader-{n}".format(n=n)))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.running = len(self.workers)
+
+    def submit(self, drive_file):
+        self.total_bytes += drive_file.size or 0
+        self.queue.put(drive_file)
+
+    def completed(self):
+        """ Yields a (drive_file, file_path, md5) tuple for every file
+        saved so far, without waiting for the rest
+        """
+        self.report_progress()
+        while True:
+            try:
+                result = self.results.get(False)
+            except Queue.Empty:
+                return
+            if result is None:
+                self.running -= 1
+            else:
+                yield result
+
+    def finish(self):
+        """ Stops the workers once all the files submitted are downloaded
+        and yields a (drive_file, file_path, md5) tuple for every file
+        saved
+        """
+        self.queue.close()
+        while self.running:
+            self.report_progress()
+            try:
+                # Waiting with a timeout lets KeyboardInterrupt through
+                result = self.results.get(True, 1)
+            except Queue.Empty:
+                continue
+            if result is None:
+                self.running -= 1
+            else:
+                yield result
+        for worker in self.workers:
+            worker.join()
+
+    def report_progress(self):
+        """ Logs the bytes downloaded, the throughput and the time left
+        if PROGRESS_INTERVAL seconds passed since the last report
+        """
+        now = time.time()
+        done = self.drive.metrics.counters['download_bytes'] - self.baseline
+        self.samples.append((now, done))
+        while self.samples[0][0] < now - self.THROUGHPUT_WINDOW:
+            self.samples.popleft()
+        if now - self.reported < self.PROGRESS_INTERVAL:
+            return
+        self.reported = now
+        (since, done_since) = self.samples[0]
+        throughput = (done - done_since) / (now - since) if now > since else 0
+        message = "Downloaded {d:.1f} of {t:.1f} MiB at {r:.2f} MiB/s".format(
+            d=done / 1048576.0, t=self.total_bytes / 1048576.0,
+            r=throughput / 1048576.0)
+        if throughput > 0 and self.total_bytes > done:
+            eta = datetime.timedelta(seconds=int((self.total_bytes - done) / throughput))
+            message += ", {e} left".format(e=eta)
+        logging.info(message)
+
+    def work(self, lane):
+        """ Worker thread main loop, it ends when the queue is closed and
+        empty
+        """
+        http = None
+        try:
+            http = self.drive.acquire_http()
+            while True:
+                drive_file = self.queue.get(lane)
+                if drive_file is None:
+                    break
+                try:
+                    with self.drive.download_slots:
+                        result = self.drive.sync_file(drive_file, http)
+                except Exception:
+                    logging.exception("Error downloading file {f}".format(
+                            f=drive_file.title.encode('utf-8')))
+                    result = None
+                if result is not None:
+                    self.results.put(result)
+        finally:
+            if http is not None:
+                self.drive.release_http(http)
+            self.results.put(None)
+
+
+class Manifest(object):
+    """ Persistent record of the synced files, stored in a SQLite database
+    in the working dir. For every file it keeps the stat tuple (inode, size,
+    mtime) it had when its MD5 was computed, so unchanged files don't need
+    to be hashed again. Changes are committed in batches.
+
+    In incremental mode it also keeps a copy of the Drive file list and
+    the token to request the changes since it was retrieved.
+
+    The exports of Google documents kept in the export cache are recorded
+    by (file ID, mime type) along with the revision they belong to.
+
+    The files in the tree and the backups can be looked up by content
+    (MD5 and size) to avoid downloading or storing them twice.
+
+    The paths are stored relative to the working dir, root.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, db_path, root=u'.'):
+        self.root = root
+        # Opened by the thread creating the Drive, then only used by the
+        # one syncing it
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                               path TEXT PRIMARY KEY,
+                               inode INTEGER,
+                               size INTEGER,
+                               mtime_ns INTEGER,
+                               md5 TEXT,
+                               file_id TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_md5 ON files (md5)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS backups (
+                               path TEXT PRIMARY KEY,
+                               md5 TEXT,
+                               size INTEGER)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS backups_md5 ON backups (md5)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS drive_files (
+                               id TEXT PRIMARY KEY,
+                               resource TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS exports (
+                               file_id TEXT,
+                               mime TEXT,
+                               modified_date TEXT,
+                               md5 TEXT,
+                               inode INTEGER,
+                               size INTEGER,
+                               mtime_ns INTEGER,
+                               PRIMARY KEY (file_id, mime))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS state (
+                               key TEXT PRIMARY KEY,
+                               value TEXT)""")
+        self.db.commit()
+        self.pending = 0
+
+    def key(self, file_path):
+        """ Returns the path of a file as stored, relative to root
+        """
+        file_path = os.path.normpath(file_path)
+        if self.root != u'.' and file_path.startswith(self.root + os.sep):
+            return file_path[len(self.root) + 1:]
+        return file_path
+
+    def path(self, key):
+        """ Returns the local path of a stored path
+        """
+        if self.root == u'.':
+            return key
+        return os.path.join(self.root, key)
+
+    def lookup(self, file_path, st):
+        """ Returns the recorded MD5 of a file if its stat didn't change,
+        otherwise None
+        """
+        row = self.db.execute(
+            "SELECT inode, size, mtime_ns, md5 FROM files WHERE path = ?",
+            (self.key(file_path),)).fetchone()
+        if row is not None and row[:3] == stat_key(st):
+            return row[3]
+        return None
+
+    def record(self, file_path, st, md5, file_id):
+        """ Records the MD5 and Drive file ID of a file with its current stat
+        """
+        (inode, size, mtime_ns) = stat_key(st)
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (self.key(file_path), inode, size, mtime_ns, md5, file_id))
+        self.changed()
+
+    def update_stat(self, file_path, st):
+        """ Updates the stat of a file whose content didn't change
+        """
+        (inode, size, mtime_ns) = stat_key(st)
+        self.db.execute(
+            "UPDATE files SET inode = ?, size = ?, mtime_ns = ? WHERE path = ?",
+            (inode, size, mtime_ns, self.key(file_path)))
+        self.changed()
+
+    def get_file_id(self, file_path):
+        """ Returns the ID of the Drive file recorded for a path or None
+        """
+        row = self.db.execute("SELECT file_id FROM files WHERE path = ?",
+                              (self.key(file_path),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def forget(self, file_path):
+        """ Removes a file from the manifest
+        """
+        self.db.execute("DELETE FROM files WHERE path = ?",
+                        (self.key(file_path),))
+        self.changed()
+
+    def prune(self, file_paths):
+        """ Removes all the files not in file_paths from the manifest
+        """
+        keep = set(self.key(p) for p in file_paths)
+        stale = [row[0] for row in self.db.execute("SELECT path FROM files")
+                 if row[0] not in keep]
+        for file_path in stale:
+            self.forget(file_path)
+
+    def find_copies(self, md5, size):
+        """ Returns the (path, inode, size, mtime_ns) tuples of the files
+        with the given content
+        """
+        return [(self.path(row[0]),) + row[1:] for row in self.db.execute(
+                """SELECT path, inode, size, mtime_ns FROM files
+                   WHERE md5 = ? AND size = ?""", (md5, size))]
+
+    def record_backup(self, file_path, st, md5):
+        self.db.execute("INSERT OR REPLACE INTO backups VALUES (?, ?, ?)",
+                        (self.key(file_path), md5, st.st_size))
+        self.changed()
+
+    def find_backups(self, md5, size):
+        """ Returns the paths of the backups with the given content
+        """
+        return [self.path(row[0]) for row in self.db.execute(
+                "SELECT path FROM backups WHERE md5 = ? AND size = ?",
+                (md5, size))]
+
+    def forget_backup(self, file_path):
+        self.db.execute("DELETE FROM backups WHERE path = ?",
+                        (self.key(file_path),))
+        self.changed()
+
+    def get_export(self, file_id, mime):
+        """ Returns the (modified_date, md5, inode, size, mtime_ns) tuple
+        of a cached export or None
+        """
+        return self.db.execute(
+            """SELECT modified_date, md5, inode, size, mtime_ns FROM exports
+               WHERE file_id = ? AND mime = ?""", (file_id, mime)).fetchone()
+
+    def get_exports(self, file_id):
+        """ Returns the (mime, modified_date) tuples of the cached exports
+        of a document
+        """
+        return self.db.execute(
+            "SELECT mime, modified_date FROM exports WHERE file_id = ?",
+            (file_id,)).fetchall()
+
+    def get_export_ids(self):
+        """ Returns the IDs of the documents with cached exports
+        """
+        return [row[0] for row in
+                self.db.execute("SELECT DISTINCT file_id FROM exports")]
+
+    def is_export(self, file_id, md5):
+        """ Returns True if md5 is the checksum of a cached export of the
+        document
+        """
+        return self.db.execute(
+            "SELECT 1 FROM exports WHERE file_id = ? AND md5 = ?",
+            (file_id, md5)).fetchone() is not None
+
+    def record_export(self, file_id, mime, modified_date, md5, st):
+        """ Records a cached export with the stat of the cached file
+        """
+        (inode, size, mtime_ns) = stat_key(st)
+        self.db.execute(
+            "INSERT OR REPLACE INTO exports VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (file_id, mime, modified_date, md5, inode, size, mtime_ns))
+        self.changed()
+
+    def update_export_stat(self, file_id, mime, st):
+        (inode, size, mtime_ns) = stat_key(st)
+        self.db.execute(
+            """UPDATE exports SET inode = ?, size = ?, mtime_ns = ?
+               WHERE file_id = ? AND mime = ?""",
+            (inode, size, mtime_ns, file_id, mime))
+        self.changed()
+
+    def forget_export(self, file_id, mime):
+        self.db.execute("DELETE FROM exports WHERE file_id = ? AND mime = ?",
+                        (file_id, mime))
+        self.changed()
+
+    def get_state(self, key):
+        """ Returns a saved value or None
+        """
+        row = self.db.execute("SELECT value FROM state WHERE key = ?",
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_state(self, key, value):
+        """ Saves a value, None removes it
+        """
+        if value is None:
+            self.db.execute("DELETE FROM state WHERE key = ?", (key,))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+                            (key, value))
+        self.changed()
+
+    def load_drive_files(self):
+        """ Returns the saved list of File resources
+        """
+        return [DriveFile.from_json(row[0]) for row in
+                self.db.execute("SELECT resource FROM drive_files")]
+
+    def save_drive_files(self, drive_files):
+        """ Replaces the saved list of File resources
+        """
+        self.db.execute("DELETE FROM drive_files")
+        for drive_file in drive_files:
+            self.save_drive_file(drive_file)
+
+    def save_drive_file(self, drive_file):
+        """ Adds or replaces a File resource in the saved list
+        """
+        self.db.execute("INSERT OR REPLACE INTO drive_files VALUES (?, ?)",
+                        (drive_file.id, drive_file.to_json()))
+        self.changed()
+
+    def delete_drive_file(self, file_id):
+        """ Removes a File resource from the saved list
+        """
+        self.db.execute("DELETE FROM drive_files WHERE id = ?", (file_id,))
+        self.changed()
+
+    def changed(self):
+        """ Commits the transaction once BATCH_SIZE changes are pending
+        """
+        self.pending += 1
+        if self.pending >= self.BATCH_SIZE:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def is_pattern(value):
+    """ Returns True if a string has shell wildcards
+    """
+    return any(c in value for c in '*?[')
+
+
+def query_string(value):
+    """ Escapes a string for a query of the listing API
+    """
+    return value.replace(u'\\', u'\\\\').replace(u"'", u"\\'")
+
+
+def drive_mtime(modified_date):
+    """ Returns the local modification time given to the files modified
+    at a date in the format of Drive
+    """
+    return time.mktime(time.strptime(modified_date, '%Y-%m-%dT%H:%M:%S.%fZ'))
+
+
+def stat_key(st):
+    """ Returns the (inode, size, mtime_ns) tuple of a stat result
+    """
+    return (st.st_ino, st.st_size, int(round(st.st_mtime * 1000000000)))
+
+
+RemoteEntry = collections.namedtuple('RemoteEntry', 'md5 size mtime drive_file')
+
+
+class SyncFilter(object):
+    """ Rules selecting the Drive files to sync:
+    include_paths: folders to sync, relative to the root of Drive, all
+    of them if empty
+    exclude_paths: shell patterns of the paths of the files and folders
+    not to sync
+    include_mimes, exclude_mimes: shell patterns of the mime types to
+    sync and not to sync
+    min_size, max_size: limits of the size of the files with content
+    modified_after, modified_before: limits of the modification date,
+    in the format of Drive
+
+    The mime types and dates are pushed down to the listing as a query,
+    the path rules decide which folders are listed at all. Folders are
+    always selected by the mime type, size and date rules.
+    """
+
+    def __init__(self, include_paths=(), exclude_paths=(), include_mimes=(),
+                 exclude_mimes=(), min_size=None, max_size=None,
+                 modified_after=None, modified_before=None):
+        paths = set(os.path.normpath(p).strip(os.sep) for p in include_paths)
+        if u'.' in paths or u'' in paths:
+            # The whole Drive
+            paths = set()
+        # The nested folders are synced with the outer ones
+        self.include_paths = sorted(p for p in paths if not any(
+                p.startswith(q + os.sep) for q in paths))
+        self.exclude_paths = sorted(set(os.path.normpath(p).strip(os.sep)
+                                        for p in exclude_paths))
+        self.include_mimes = sorted(set(include_mimes))
+        self.exclude_mimes = sorted(set(exclude_mimes))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        self.path_rules = bool(self.include_paths or self.exclude_paths)
+        self.excluded = None
+        if self.exclude_paths:
+            self.excluded = re.compile('|'.join(fnmatch.translate(p)
+                                                for p in self.exclude_paths))
+
+    def fingerprint(self):
+        """ Returns a string which changes with the rules
+        """
+        return json.dumps([self.include_paths, self.exclude_paths,
+                           self.include_mimes, self.exclude_mimes,
+                           self.min_size, self.max_size,
+                           self.modified_after, self.modified_before])
+
+    def query(self):
+        """ Returns the query for the listing API selecting the files by
+        mime type and modification date as far as it can be expressed,
+        or None
+        """
+        conditions = []
+        if self.include_mimes and not any(is_pattern(m) for m in self.include_mimes):
+            conditions.append(u'({c})'.format(c=u' or '.join(
+                        u"mimeType = '{m}'".format(m=query_string(m))
+                        for m in self.include_mimes)))
+        for mime in self.exclude_mimes:
+            if not is_pattern(mime):
+                conditions.append(u"mimeType != '{m}'".format(m=query_string(mime)))
+        if self.modified_after is not None:
+            conditions.append(u"modifiedDate >= '{d}'".format(d=self.modified_after))
+        if self.modified_before is not None:
+            conditions.append(u"modifiedDate < '{d}'".format(d=self.modified_before))
+        if not conditions:
+            return None
+        return u"mimeType = '{f}' or ({c})".format(f=Drive.FOLDER_MIMETYPE,
+                                                  c=u' and '.join(conditions))
+
+    def accepts(self, drive_file):
+        """ Returns True if the mime type, size and modification date of a
+        file are selected
+        """
+        mime = drive_file.mime_type
+        if mime == Drive.FOLDER_MIMETYPE:
+            return True
+        if self.include_mimes and not any(fnmatch.fnmatchcase(mime, m)
+                                          for m in self.include_mimes):
+            return False
+        if any(fnmatch.fnmatchcase(mime, m) for m in self.exclude_mimes):
+            return False
+        if drive_file.size is not None:
+            if self.min_size is not None and drive_file.size < self.min_size:
+                return False
+            if self.max_size is not None and drive_file.size > self.max_size:
+                return False
+        if self.modified_after is not None and \
+                drive_file.modified_date < self.modified_after:
+            return False
+        if self.modified_before is not None and \
+                drive_file.modified_date >= self.modified_before:
+            return False
+        return True
+
+    def accepts_stat(self, st):
+        """ Returns True if the size and modification time of a local file
+        are selected, the files which aren't don't belong to the sync
+        """
+        if self.min_size is not None and st.st_size < self.min_size:
+            return False
+        if self.max_size is not None and st.st_size > self.max_size:
+            return False
+        if self.modified_after is not None and \
+                st.st_mtime < drive_mtime(self.modified_after):
+            return False
+        if self.modified_before is not None and \
+                st.st_mtime >= drive_mtime(self.modified_before):
+            return False
+        return True
+
+    def accepts_path(self, path, is_folder=False):
+        """ Returns True if the path rules select a normalized path. The
+        folders above the included ones are selected too, so they can be
+        walked to reach them, starting with the root.
+        """
+        if path in (os.curdir, u''):
+            return True
+        if self.excluded is not None:
+            parts = path.split(os.sep)
+            for n in range(1, len(parts) + 1):
+                if self.excluded.match(os.sep.join(parts[:n])):
+                    return False
+        if not self.include_paths:
+            return True
+        for include_path in self.include_paths:
+            if path == include_path or path.startswith(include_path + os.sep):
+                return True
+            if is_folder and include_path.startswith(path + os.sep):
+                return True
+        return False
+
+
+class SyncPlan(object):
+    """ The actions needed to make the local tree match Drive:
+    keep: local paths already up to date
+    download: Drive files to download
+    backup: local paths to move to the backup folder
+    fix_mtime: (local path, mtime) tuples of files whose content matches
+    discard: partial downloads which can't be resumed
+    """
+
+    def __init__(self):
+        self.keep = []
+        self.download = []
+        self.backup = []
+        self.fix_mtime = []
+        self.discard = []
+
+    def __str__(self):
+        return "Sync plan: {k} to keep, {d} to download, {b} to backup, {m} mtimes to fix".format(
+            k=len(self.keep), d=len(self.download), b=len(self.backup),
+            m=len(self.fix_mtime))
+
+
+class SyncPipeline(object):
+    """ Plans and carries out the sync while the Drive files are listed.
+    A file is planned as soon as all the folders above it are known, and
+    its download starts right away. Local files are looked up by path;
+    the ones which need hashing go to the pool of the LocalScan and are
+    planned when their hash arrives.
+
+    Whatever depends on the whole list waits until the listing finishes
+    and only happens if it was complete: backing up the local files not
+    in Drive, removing stale partial downloads and pruning the manifest.
+    The planning happens in the thread feeding the pages, which is the
+    only one touching the manifest.
+
+    To sync only some changes, remote has the entries of the files which
+    don't need to be planned again, and the scan only covers the local
+    paths changed.
+    """
+
+    def __init__(self, drive, scan, remote=None):
+        self.drive = drive
+        self.scan = scan
+        self.plan = SyncPlan()
+        self.full = remote is None
+        # Normalized path -> RemoteEntry of every file planned
+        self.remote = remote if remote is not None else {}
+        # Normalized path -> RemoteEntry of the newest file with a path
+        # shared with other files, it's synced once all are listed
+        self.deferred = {}
+        # Folder ID -> files waiting for the folder to be listed
+        self.waiting = {}
+        # Normalized path -> (stat, RemoteEntry) of the files being hashed
+        self.unhashed = {}
+        # Normalized path -> MD5 of the files hashed before being needed
+        self.hashed = {}
+        self.downloading = set()
+        self.duplicates = []
+        self.saved = set()
+        self.pages = 0
+        self.backed_up = 0
+        self.dispatched = 0
+        self.downloader = Downloader(drive, drive.jobs)
+        self.downloader.start()
+
+    def add_page(self, drive_files):
+        """ Plans the files of a page of the listing, once it's indexed
+        in the file tree, and the ones which were waiting for them
+        """
+        self.pages += 1
+        for drive_file in drive_files:
+            for waiting_file in self.waiting.pop(drive_file.id, ()):
+                self.add(waiting_file)
+            self.add(drive_file)
+        self.update()
+
+    def add(self, drive_file):
+        """ Plans a file if the folders above it are known, otherwise it
+        waits for the first one missing
+        """
+        if not self.drive.is_synced(drive_file):
+            return
+        missing = self.drive.tree.missing_ancestor(drive_file)
+        if missing is None:
+            self.plan_file(drive_file)
+        else:
+            self.waiting.setdefault(missing, []).append(drive_file)
+
+    def plan_file(self, drive_file):
+        if not self.drive.in_scope(drive_file):
+            return
+        file_path = os.path.normpath(self.drive.get_path(drive_file))
+        entry = self.drive.remote_entry(drive_file)
+        other = self.deferred.get(file_path) or self.remote.get(file_path)
+        if other is not None:
+            logging.warning("Several Drive files share the path {f}, keeping the newest one".format(
+                    f=file_path.encode('utf-8')))
+            if other.drive_file.modified_date <= drive_file.modified_date:
+                self.deferred[file_path] = entry
+            return
+        if self.drive.manifest.get_file_id(file_path) not in (None, drive_file.id):
+            # The local file belongs to another Drive file with the same
+            # path, wait for the newest one
+            self.deferred[file_path] = entry
+            return
+        self.remote[file_path] = entry
+        self.compare(file_path, entry)
+
+    def compare(self, file_path, entry, wait=False):
+        """ Compares a file with the local file in its path. If it needs
+        hashing, it's hashed in the pool, unless wait is True.
+        """
+        drive = self.drive
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self.plan.download.append(entry.drive_file)
+        elif drive.compare_local(self.plan, file_path, st, entry):
+            pass
+        elif wait:
+            self.compare_hashed(file_path, st, entry,
+                                drive.hash_file(file_path))
+        elif file_path in self.hashed:
+            self.compare_hashed(file_path, st, entry,
+                                self.hashed.pop(file_path))
+        else:
+            self.unhashed[file_path] = (st, entry)
+            self.scan.submit(file_path)
+
+    def compare_hashed(self, file_path, st, entry, md5):
+        if md5 is not None:
+            self.drive.manifest.record(file_path, st, md5,
+                                       entry.drive_file.id)
+        self.drive.compare_hashed(self.plan, file_path, st, entry, md5)
+
+    def collect_hashes(self, block=False):
+        """ Plans the files hashed so far. If block is True, it waits for
+        all the files being hashed.
+        """
+        for (file_path, md5) in self.scan.hashes(block):
+            pending = self.unhashed.pop(file_path, None)
+            if pending is None:
+                self.hashed[file_path] = md5
+                continue
+            (st, entry) = pending
+            self.compare_hashed(file_path, st, entry, md5)
+            if block and not self.unhashed:
+                break
+
+    def update(self):
+        """ Carries out the actions added to the plan since the last
+        update: backs up the local files to replace and submits the
+        downloads. The files downloaded so far are recorded.
+        """
+        drive = self.drive
+        self.collect_hashes()
+        for file_path in self.plan.backup[self.backed_up:]:
+            drive.backup_file(file_path)
+        self.backed_up = len(self.plan.backup)
+        for drive_file in self.plan.download[self.dispatched:]:
+            self.download(drive_file)
+        self.dispatched = len(self.plan.download)
+        drive.save_results(self.track(self.downloader.completed()))
+
+    def track(self, results):
+        """ Keeps the IDs of the files in the results of the Downloader
+        """
+        for result in results:
+            self.saved.add(result[0].id)
+            yield result
+
+    def failed(self):
+        """ Returns the IDs of the files which couldn't be saved
+        """
+        return set(drive_file.id for drive_file in self.plan.download) - self.saved
+
+    def download(self, drive_file):
+        """ Saves a file from the export cache or a local copy with the
+        same content if possible, otherwise submits its download
+        """
+        drive = self.drive
+        key = content_key(drive_file)
+        if key is None:
+            if drive.restore_export(drive_file):
+                self.saved.add(drive_file.id)
+                return
+        elif key in self.downloading:
+            # Copy it once the first one is downloaded
+            self.duplicates.append(drive_file)
+            return
+        elif drive.copy_local(drive_file):
+            self.saved.add(drive_file.id)
+            return
+        else:
+            self.downloading.add(key)
+        self.downloader.submit(drive_file)
+
+    def finish(self, complete):
+        """ Plans the files left once the listing finishes, cleans up the
+        local tree if the list is complete and waits for the downloads.
+
+        Returns the SyncPlan"""
+        drive = self.drive
+        waiting = [drive_file for drive_files in self.waiting.itervalues()
+                   for drive_file in drive_files]
+        self.waiting = {}
+        if complete:
+            # Their folders aren't visible to us, they go to the root
+            for drive_file in waiting:
+                self.plan_file(drive_file)
+        elif waiting:
+            logging.warning("{n} files skipped, their folders weren't listed".format(
+                    n=len(waiting)))
+        for (file_path, entry) in self.deferred.items():
+            if file_path not in self.remote:
+                del self.deferred[file_path]
+                self.remote[file_path] = entry
+                self.compare(file_path, entry)
+        if self.unhashed:
+            self.collect_hashes(True)
+        self.update()
+        if complete:
+            logging.info("Cleaning up the local tree...")
+            self.clean(self.scan.wait())
+            self.update()
+        else:
+            logging.error("The file list is incomplete, not cleaning up the local tree")
+        drive.save_results(self.track(self.downloader.finish()))
+        # The copies of the files downloaded and the newest of the files
+        # sharing a path go in further rounds
+        while self.duplicates or self.deferred:
+            self.downloader = Downloader(drive, drive.jobs)
+            self.downloader.start()
+            self.downloading.clear()
+            (duplicates, self.duplicates) = (self.duplicates, [])
+            for drive_file in duplicates:
+                self.download(drive_file)
+            for (file_path, entry) in self.deferred.iteritems():
+                self.remote[file_path] = entry
+                self.compare(file_path, entry, wait=True)
+            self.deferred = {}
+            self.update()
+            drive.save_results(self.track(self.downloader.finish()))
+        for (file_path, mtime) in self.plan.fix_mtime:
+            set_mtime(file_path, mtime)
+            try:
+                drive.manifest.update_stat(file_path, os.stat(file_path))
+            except OSError as e:
+                logging.error("Error {n} reading file {f}: {e}".format(
+                    n=e.errno,
+                    f=file_path.encode('utf-8'),
+                    e=e.strerror))
+        if complete and self.full:
+            drive.manifest.prune(self.remote)
+            drive.prune_exports()
+        drive.manifest.commit()
+        if complete and self.full:
+            drive.remove_empty_dirs()
+        else:
+            # Only the folders left empty by the backups
+            for file_path in self.plan.backup:
+                try:
+                    os.removedirs(os.path.dirname(file_path))
+                except OSError:
+                    pass
+        logging.info(str(self.plan))
+        return self.plan
+
+    def clean(self, local_files):
+        """ Adds to the plan the local files not in Drive and removes the
+        partial downloads which can't be resumed. The ones of the files
+        being downloaded are left alone.
+        """
+        drive = self.drive
+        download_paths = set(os.path.normpath(drive.get_path(drive_file))
+                             for drive_file in self.plan.download)
+        local_only = []
+        for (file_path, st) in local_files:
+            if os.path.normpath(file_path) in self.remote:
+                continue
+            if file_path.endswith(drive.PARTIAL_SUFFIX) or \
+                    file_path.endswith(drive.PARTIAL_SUFFIX + drive.SIDECAR_SUFFIX):
+                target = file_path.rsplit(drive.PARTIAL_SUFFIX, 1)[0]
+                if os.path.normpath(target) in download_paths:
+                    continue
+            local_only.append((file_path, st))
+        # Told apart before removing any, a partial file and its sidecar
+        # vouch for each other
+        partials = set(file_path for (file_path, st) in local_only
+                       if drive.is_partial(file_path))
+        for (file_path, st) in local_only:
+            if file_path in partials:
+                self.plan.discard.append(file_path)
+                drive.discard_partial(file_path)
+            elif drive.filter.accepts_stat(st):
+                # Not in Drive or not selected any more
+                self.plan.backup.append(file_path)
+
+
+class DriveFile(object):
+    """ The fields of a Drive File resource needed to sync it. Listing a
+    big Drive keeps lots of these in memory, so they use slots instead
+    of the resource dictionaries.
+    """
+    __slots__ = ('id', 'title', 'mime_type', 'parent_id', 'parent_is_root',
+                 'md5', 'size', 'modified_date', 'trashed', 'export_links',
+                 'download_url', 'extension')
+
+    def __init__(self, *values):
+        for (slot, value) in zip(self.__slots__, values):
+            setattr(self, slot, value)
+
+    @classmethod
+    def from_resource(cls, resource):
+        """ Builds a DriveFile from a File resource of the API
+        """
+        parents = resource.get('parents')
+        if parents:
+            parent_id = parents[0]['id']
+            parent_is_root = parents[0].get('isRoot', False)
+        else:
+            parent_id = None
+            parent_is_root = False
+        size = resource.get('fileSize')
+        if size is not None:
+            size = int(size)
+        return cls(resource['id'],
+                   resource['title'],
+                   share(resource['mimeType']),
+                   parent_id,
+                   parent_is_root,
+                   resource.get('md5Checksum'),
+                   size,
+                   resource['modifiedDate'],
+                   resource.get('labels', {}).get('trashed', False),
+                   resource.get('exportLinks'),
+                   resource.get('downloadUrl'),
+                   resource.get('fileExtension', u''))
+
+    @classmethod
+    def from_json(cls, value):
+        """ Builds a DriveFile saved with to_json
+        """
+        values = json.loads(value)
+        if isinstance(values, dict):
+            # Saved as a whole File resource
+            return cls.from_resource(values)
+        values[2] = share(values[2])
+        return cls(*values)
+
+    def to_json(self):
+        return json.dumps([getattr(self, slot) for slot in self.__slots__])
+
+
+# Repeated strings, like mime types, are shared by all the files
+SHARED_STRINGS = {}
+
+
+def share(value):
+    """ Returns the shared copy of a string
+    """
+    return SHARED_STRINGS.setdefault(value, value)
+
+
+def content_key(drive_file):
+    """ Returns the (md5, size) tuple of a file, None for documents
+    """
+    if drive_file.md5 is None:
+        return None
+    return (drive_file.md5, drive_file.size or 0)
+
+
+def path_key(drive_file):
+    """ Returns the attributes of a file which affect its local path
+    """
+    return (drive_file.title,
+            drive_file.parent_id,
+            drive_file.mime_type,
+            drive_file.trashed)
+
+
+def set_mtime(file_path, mtime):
+    """Sets the modification time of a file, mtime can be a struct_time
+    or a timestamp
+    """
+    if isinstance(mtime, time.struct_time):
+        mtime = time.mktime(mtime)
+    try:
+        os.utime(file_path, (mtime, mtime))
+    except OSError as e:
+        logging.error("Error {n} updating the mtime of the file {f}: {e}".format(
+            n=e.errno,
+            f=e.filename.encode('utf-8'),
+            e=e.strerror))
+
+
+def link_or_copy(src, dst):
+    """Makes dst a hard link to src, or a copy if that's not possible
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+# ioctl to share the data blocks of a file with another (Linux)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Copies src to dst. It's a reflink (the copy shares the data blocks
+    until one of them is modified) if the file system supports it.
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except (IOError, OSError):
+                pass
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def scan_tree(top, is_system_dir=None, is_system_file=None, is_excluded=None):
+    """Walks a tree and yields a (path, stat) tuple for every file. The
+    stat comes from scandir when available. Symbolic links to folders
+    aren't followed and the system files and folders of the top level
+    are skipped, if the functions to tell them are given. If is_excluded
+    is given, the files and folders for which it's True are skipped at
+    any level, it's called with the path and True for folders.
+    """
+    pending = [top]
+    while pending:
+        dir = pending.pop()
+        try:
+            entries = list(scan_dir(dir))
+        except OSError as e:
+            logging.error("Error {n} reading folder {f}: {e}".format(
+                n=e.errno,
+                f=dir.encode('utf-8'),
+                e=e.strerror))
+            continue
+        for (path, st) in entries:
+            if dir == top and is_system_dir is not None:
+                if is_system_dir(path) or is_system_file(os.path.basename(path)):
+                    continue
+            if is_excluded is not None and is_excluded(path, st is None):
+                continue
+            if st is None:
+                pending.append(path)
+            else:
+                yield (path, st)
+
+
+def scan_paths(paths, is_excluded=None):
+    """Yields a (path, stat) tuple for every regular file in paths and in
+    the folders in paths, once. The paths which don't exist are skipped,
+    and the ones for which is_excluded is True, like in scan_tree.
+    """
+    found = set()
+    for path in paths:
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                st = os.stat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    continue
+        except OSError:
+            continue
+        if is_excluded is not None and is_excluded(path, stat.S_ISDIR(st.st_mode)):
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            items = scan_tree(path, is_excluded=is_excluded)
+        elif stat.S_ISREG(st.st_mode):
+            items = [(path, st)]
+        else:
+            continue
+        for (file_path, st) in items:
+            file_path = os.path.normpath(file_path)
+            if file_path not in found:
+                found.add(file_path)
+                yield (file_path, st)
+
+
+def scan_dir(dir):
+    """Yields a (path, stat) tuple for every regular file in a folder and
+    a (path, None) tuple for every subfolder
+    """
+    if scandir is not None:
+        for entry in scandir(dir):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield (entry.path, None)
+                elif entry.is_file():
+                    yield (entry.path, entry.stat())
+            except OSError:
+                # Broken or vanished entry
+                continue
+        return
+    for name in os.listdir(dir):
+        path = os.path.join(dir, name)
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                st = os.stat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    continue
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            yield (path, None)
+        elif stat.S_ISREG(st.st_mode):
+            yield (path, st)
+
+
+def hash_job(file_path):
+    """Hashes a file in a worker process of LocalScan.
+
+    Returns a (file_path, md5, size, seconds) tuple, md5 is None on errors"""
+    start = time.time()
+    try:
+        md5 = md5_for_file(file_path)
+        size = os.path.getsize(file_path)
+    except Exception as e:
+        logging.error("Error reading file {f}: {e}".format(
+            f=file_path.encode('utf-8'),
+            e=e))
+        (md5, size) = (None, 0)
+    return (file_path, md5, size, time.time() - start)
+
+
+# Large reads keep fast disks and arrays busy
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def md5_for_file(file_path):
+    with open(file_path, 'rb') as fh:
+        m = hashlib.md5()
+        while True:
+            data = fh.read(HASH_BUFFER_SIZE)
+            if not data:
+                break
+            m.update(data)
+        return m.hexdigest()
+
+
+# Formats the Google documents are converted to
+OPENDOCUMENT_CONVERSION = {u'application/vnd.google-apps.document': u'application/vnd.oasis.opendocument.text',
+                           u'application/vnd.google-apps.spreadsheet': u'application/x-vnd.oasis.opendocument.spreadsheet',
+                           u'application/vnd.google-apps.drawing': u'image/svg+xml',
+                           u'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+                           }
+
+PDF_CONVERSION = {u'application/vnd.google-apps.document': u'application/pdf',
+                  u'application/vnd.google-apps.spreadsheet': u'application/pdf',
+                  u'application/vnd.google-apps.drawing': u'application/pdf',
+                  u'application/vnd.google-apps.presentation': u'application/pdf'
+                  }
+
+
+def parse_size(value):
+    """ Parses a size in bytes, with an optional K, M, G or T suffix
+    """
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', value.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError("invalid size: {v}".format(v=value))
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' '))
+
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def parse_window(value):
+    """ Parses a bandwidth window like "mon-fri 08:00-18:00=1M": the days
+    are optional, a comma separated list of day names or ranges, the end
+    can be 24:00 and the cap has an optional K, M, G or T suffix
+    """
+    match = re.match(r'^(?:([a-z,-]+)\s+)?(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\S+)$',
+                     value.strip().lower())
+    if match is None:
+        raise argparse.ArgumentTypeError("invalid bandwidth window: {v}".format(v=value))
+    (days, start_hour, start_minute, end_hour, end_minute, rate) = match.groups()
+    start = int(start_hour) * 60 + int(start_minute)
+    end = int(end_hour) * 60 + int(end_minute)
+    if int(start_hour) > 23 or int(start_minute) > 59 or int(end_minute) > 59 or \
+            end > 24 * 60:
+        raise argparse.ArgumentTypeError("invalid time in bandwidth window: {v}".format(v=value))
+    if start == end:
+        raise argparse.ArgumentTypeError("empty bandwidth window: {v}".format(v=value))
+    weekdays = set()
+    for part in (days or 'mon-sun').split(','):
+        (first, sep, last) = part.partition('-')
+        if first not in DAY_NAMES or (last or first) not in DAY_NAMES:
+            raise argparse.ArgumentTypeError("invalid days: {d}".format(d=part))
+        day = DAY_NAMES.index(first)
+        weekdays.add(day)
+        while day != DAY_NAMES.index(last or first):
+            day = (day + 1) % 7
+            weekdays.add(day)
+    return BandwidthWindow(weekdays, start, end, parse_size(rate))
+
+
+def parse_date(value):
+    """ Parses a date, with an optional time, into the format of Drive
+    """
+    for date_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            date = datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        return date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    raise argparse.ArgumentTypeError("invalid date: {v}".format(v=value))
+
+
+def lock_path(working_dir):
+    """ Returns the path of the lock file of a working dir, in the runtime
+    dir of the user
+    """
+    base_lockfile = os.path.join('/var/run/user', str(os.getuid()))
+    if not os.path.isdir(base_lockfile):
+        base_lockfile = '/tmp'
+    working_dir = os.path.abspath(working_dir)
+    if isinstance(working_dir, unicode):
+        working_dir = working_dir.encode(sys.getfilesystemencoding())
+    digest = hashlib.md5(working_dir).hexdigest()
+    return os.path.join(base_lockfile, '.drive-downloader-' + digest[:16])
+
+
+# Options of the configuration file which can't differ between accounts
+GLOBAL_OPTIONS = frozenset(['jobs', 'hash_jobs', 'bandwidth', 'bandwidth_window',
+                            'profile', 'log_level', 'config'])
+
+
+def config_argv(options):
+    """ Converts the options of the configuration file to command line
+    arguments. A list gives the option several times, true gives a flag.
+    """
+    argv = []
+    for (key, value) in sorted(options.items()):
+        option = '--' + key.replace('_', '-')
+        for value in (value if isinstance(value, list) else [value]):
+            if value is True:
+                argv.append(option)
+            elif value is not False and value is not None:
+                argv.extend([option, unicode(value).encode(sys.getfilesystemencoding())])
+    return argv
+
+
+def load_config(parser, argv):
+    """ Reads the configuration file of several accounts. Its top level
+    options apply to all the accounts and override the command line, the
+    options of every account override both.
+
+    Returns the global options and a list with the options of every
+    account"""
+    args = parser.parse_args(argv)
+    try:
+        with open(args.config) as f:
+            config = json.load(f)
+        accounts = config.pop('accounts')
+        if not isinstance(accounts, list) or not accounts:
+            raise ValueError("no accounts")
+    except (IOError, ValueError, KeyError, AttributeError) as e:
+        parser.error("invalid configuration file {f}: {e}".format(
+                f=args.config, e=e))
+    argv = argv + config_argv(config)
+    accounts_args = []
+    metrics_files = {}
+    for account in accounts:
+        account = dict(account)
+        name = account.pop('name', None)
+        if name is not None:
+            name = unicode(name)
+        for key in account:
+            if key.replace('-', '_') in GLOBAL_OPTIONS:
+                parser.error("option {o} can't be set for a single account".format(o=key))
+        account_args = parser.parse_args(argv + config_argv(account))
+        account_args.name = name or os.path.basename(os.path.abspath(
+                account_args.working_dir)).decode(sys.getfilesystemencoding())
+        if account_args.metrics:
+            metrics_file = os.path.abspath(account_args.metrics)
+            if metrics_file in metrics_files:
+                parser.error("accounts {a} and {b} can't save their metrics to the same file {f}".format(
+                        a=metrics_files[metrics_file].encode('utf-8'),
+                        b=account_args.name.encode('utf-8'), f=metrics_file))
+            metrics_files[metrics_file] = account_args.name
+        accounts_args.append(account_args)
+    return (parser.parse_args(argv), accounts_args)
+
+
+def new_drive(args, **kwargs):
+    """ Creates the Drive of an account with its command line options
+    """
+    encoding = sys.getfilesystemencoding()
+    sync_filter = SyncFilter(include_paths=[p.decode(encoding) for p in args.include],
+                             exclude_paths=[p.decode(encoding) for p in args.exclude],
+                             include_mimes=args.include_mime,
+                             exclude_mimes=args.exclude_mime,
+                             min_size=args.min_size,
+                             max_size=args.max_size,
+                             modified_after=args.modified_after,
+                             modified_before=args.modified_before)
+    if args.convert == "opendocument":
+        conv = OPENDOCUMENT_CONVERSION
+    elif args.convert == "pdf":
+        conv = PDF_CONVERSION
+    else:
+        print("Unknown conversion option: {c}".format(c=args.convert))
+    return Drive(client_secrets=os.path.abspath(args.client_secrets),
+                 conversion=conv,
+                 verify=args.verify,
+                 incremental=args.incremental or args.daemon,
+                 jobs=args.jobs,
+                 rate=args.rate,
+                 hash_jobs=args.hash_jobs,
+                 metrics_file=args.metrics and os.path.abspath(args.metrics),
+                 sync_filter=sync_filter,
+                 bandwidth=args.bandwidth,
+                 bandwidth_windows=args.bandwidth_window,
+                 oauth_storage=args.oauth_storage and
+                     os.path.abspath(args.oauth_storage.decode(encoding)),
+                 **kwargs)
+
+
+def sync_account(drive, args):
+    """ Syncs an account in its own thread, once or until stopped in daemon
+    mode
+    """
+    try:
+        logging.info("Authorizing...")
+        drive.authorize()
+        drive.start_scan()
+        if args.daemon:
+            logging.info("Syncing every {n} seconds...".format(n=args.interval))
+            drive.serve(args.interval)
+        else:
+            logging.info("Retrieving the file list and downloading the files...")
+            drive.sync()
+    except Exception:
+        logging.exception("Error syncing the account")
+    finally:
+        drive.close()
+        drive.metrics.summary()
+        drive.metrics.save()
+
+
+def sync_accounts(args, accounts):
+    """ Syncs several accounts at the same time, every one in its own
+    thread and working dir, sharing the hashing processes, the connections,
+    args.jobs download slots and the bandwidth cap. The accounts whose
+    working dir is locked by another run are skipped.
+    """
+    encoding = sys.getfilesystemencoding()
+    shared = SharedResources(args.jobs, args.hash_jobs, args.bandwidth,
+                             args.bandwidth_window)
+    locks = {}
+    syncs = []
+    try:
+        for account_args in accounts:
+            working_dir = os.path.abspath(account_args.working_dir)
+            lockfile = lock_path(working_dir)
+            if lockfile in locks:
+                logging.error("Account {a} syncs to the same working dir as another one, skipping it".format(
+                        a=account_args.name.encode('utf-8')))
+                continue
+            if not os.path.isdir(working_dir):
+                logging.error("Working dir {d} of account {a} not found, skipping it".format(
+                        d=working_dir, a=account_args.name.encode('utf-8')))
+                continue
+            lock = LockFile(lockfile)
+            try:
+                lock.acquire(0)
+            except LockError:
+                logging.error("Working dir {d} is locked by another run, skipping account {a}".format(
+                        d=working_dir, a=account_args.name.encode('utf-8')))
+                continue
+            locks[lockfile] = lock
+            logging.info("Account {a}: {d}".format(
+                    a=account_args.name.encode('utf-8'), d=working_dir))
+            # The credentials may be asked here, one account at a time
+            drive = new_drive(account_args,
+                              working_dir=working_dir.decode(encoding),
+                              shared=shared,
+                              name=account_args.name)
+            thread = threading.Thread(target=sync_account,
+                                      args=(drive, account_args),
+                                      name=account_args.name.encode('utf-8'))
+            thread.daemon = True
+            syncs.append((drive, thread))
+        for (drive, thread) in syncs:
+            thread.start()
+        try:
+            for (drive, thread) in syncs:
+                while thread.is_alive():
+                    # Waiting with a timeout lets KeyboardInterrupt through
+                    thread.join(1)
+        except KeyboardInterrupt:
+            logging.info("Interrupted, stopping after the syncs in progress")
+            for (drive, thread) in syncs:
+                drive.stop()
+            for (drive, thread) in syncs:
+                while thread.is_alive():
+                    thread.join(1)
+    finally:
+        shared.close()
+        for lock in locks.values():
+            lock.release()
+
+
+def sync_working_dir(args):
+    """ Syncs a single account in the working dir, which is made the
+    current directory meanwhile. The manifest is closed and the metrics
+    are saved even if the sync fails or is interrupted.
+    """
+    previous_dir = os.getcwd()
+    lockfile = lock_path(args.working_dir)
+    logging.debug("Working dir: {dir}".format(dir=os.path.abspath(args.working_dir)))
+    logging.debug("Client secrets: {secrets}".format(secrets=args.client_secrets))
+    logging.debug("Lock file: {f}".format(f=lockfile))
+    if args.metrics:
+        args.metrics = os.path.abspath(args.metrics)
+    if args.oauth_storage:
+        args.oauth_storage = os.path.abspath(args.oauth_storage)
+    os.chdir(os.path.abspath(args.working_dir))
+    lock = LockFile(lockfile)
+    try:
+        with lock:
+            logging.debug("Lock file acquired: {f}".format(f=lock.path))
+            drive_service = new_drive(args)
+            try:
+                logging.info("Authorizing...")
+                drive_service.authorize()
+                drive_service.start_scan()
+                if args.daemon:
+                    logging.info("Syncing every {n} seconds...".format(n=args.interval))
+                    try:
+                        drive_service.serve(args.interval)
+                    except KeyboardInterrupt:
+                        logging.info("Interrupted, stopping")
+                else:
+                    logging.info("Retrieving the file list and downloading the files...")
+                    drive_service.sync()
+            finally:
+                drive_service.close()
+                drive_service.metrics.summary()
+                drive_service.metrics.save()
+    finally:
+        os.chdir(previous_dir)
+
+
+def main(argv):
+    client_secrets_default = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                          "client_secrets.json")
+    client_secrets_help = """JSON file with your Google Drive API credentials.
+    https://developers.google.com/drive/web/about-auth
+    (default: client_secrets.json)"""
+    
+    working_dir_default = os.getcwd()
+    working_dir_help = """Root directory to download your Drive content.
+    (default: the current directory)"""
+
+    oauth_storage_help = """File to store the OAuth2 credentials in
+    (default: .oauth2.json in the working dir)"""
+
+    config_help = """JSON file with the accounts to sync at the same time,
+    every one with its own working dir and options. The download jobs,
+    hashing processes and bandwidth are shared between them"""
+
+    convert_choices = ["opendocument", "pdf"]
+    convert_default = "opendocument"
+    convert_help = """Which format convert the Google documents to (opendocument|pdf)
+    (default: opendocument)"""
+
+    verify_help = """Hash all the local files again instead of trusting
+    their size, mtime and the local manifest"""
+
+    incremental_help = """Only retrieve the changes since the last run
+    instead of the whole file list"""
+
+    jobs_default = 1
+    jobs_help = """Number of files to download in parallel
+    (default: 1)"""
+
+    hash_jobs_default = multiprocessing.cpu_count()
+    hash_jobs_help = """Number of processes hashing local files
+    (default: the number of CPUs)"""
+
+    daemon_help = """Keep running and sync the changes every INTERVAL
+    seconds"""
+
+    interval_default = 60
+    interval_help = """Seconds between syncs in daemon mode
+    (default: 60)"""
+
+    rate_default = 10
+    rate_help = """Maximum number of requests per second to the Drive API,
+    0 for no limit (default: 10)"""
+
+    include_help = """Folder of Drive to sync, relative to its root. Can be
+    given several times (default: all of them)"""
+
+    exclude_help = """Shell pattern of the paths of the files and folders
+    not to sync, relative to the root of Drive. Can be given several times"""
+
+    include_mime_help = """Shell pattern of the mime types to sync. Can be
+    given several times (default: all of them)"""
+
+    exclude_mime_help = """Shell pattern of the mime types not to sync. Can
+    be given several times"""
+
+    min_size_help = """Minimum size of the files to sync, with an optional
+    K, M, G or T suffix"""
+
+    max_size_help = """Maximum size of the files to sync, with an optional
+    K, M, G or T suffix"""
+
+    modified_after_help = """Only sync the files modified since this date,
+    in UTC (YYYY-MM-DD[THH:MM:SS])"""
+
+    modified_before_help = """Only sync the files modified before this date,
+    in UTC (YYYY-MM-DD[THH:MM:SS])"""
+
+    bandwidth_help = """Maximum download bandwidth in bytes per second, with
+    an optional K, M, G or T suffix, 0 for no limit (default: 0)"""
+
+    bandwidth_window_help = """Maximum download bandwidth for a time of the
+    day, in local time, like "mon-fri 08:00-18:00=1M". A cap of 0 pauses the
+    downloads. The days are optional. Can be given several times"""
+
+    metrics_help = """File to save the metrics of the run to, as JSON if its
+    name ends with .json, otherwise in the Prometheus text format"""
+
+    profile_help = """File to save a profile of all the threads to, in the
+    collapsed stack format of flamegraph.pl"""
+
+    loglevel_choices = ["debug", "info", "warning", "error", "critical"]
+    loglevel_default = "info"
+    loglevel_help = """Verbosity level"""
+
+    program_description = """Drive downloader is a program to download the
+    contents of your Google Drive account."""
+    
+    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description=program_description)
+    parser.add_argument("-w", "--working-dir", help=working_dir_help,
+                        default=working_dir_default)
     parser.add_argument("-c", "--client-secrets", help=client_secrets_help,
                         default=client_secrets_default)
+    parser.add_argument("--oauth-storage", help=oauth_storage_help,
+                        metavar="FILE")
+    parser.add_argument("--config", help=config_help, metavar="FILE")
     parser.add_argument("-o", "--convert", help=convert_help,
                         choices=convert_choices,
                         default=convert_default)
+    parser.add_argument("--verify", help=verify_help, action="store_true")
+    parser.add_argument("-i", "--incremental", help=incremental_help,
+                        action="store_true")
+    parser.add_argument("-j", "--jobs", help=jobs_help, type=int,
+                        default=jobs_default)
+    parser.add_argument("--hash-jobs", help=hash_jobs_help, type=int,
+                        default=hash_jobs_default)
+    parser.add_argument("-r", "--rate", help=rate_help, type=float,
+                        default=rate_default)
+    parser.add_argument("-d", "--daemon", help=daemon_help,
+                        action="store_true")
+    parser.add_argument("--interval", help=interval_help, type=float,
+                        default=interval_default)
+    parser.add_argument("--include", help=include_help, action="append",
+                        default=[], metavar="FOLDER")
+    parser.add_argument("--exclude", help=exclude_help, action="append",
+                        default=[], metavar="PATTERN")
+    parser.add_argument("--include-mime", help=include_mime_help,
+                        action="append", default=[], metavar="MIME")
+    parser.add_argument("--exclude-mime", help=exclude_mime_help,
+                        action="append", default=[], metavar="MIME")
+    parser.add_argument("--min-size", help=min_size_help, type=parse_size)
+    parser.add_argument("--max-size", help=max_size_help, type=parse_size)
+    parser.add_argument("--modified-after", help=modified_after_help,
+                        type=parse_date, metavar="DATE")
+    parser.add_argument("--modified-before", help=modified_before_help,
+                        type=parse_date, metavar="DATE")
+    parser.add_argument("--bandwidth", help=bandwidth_help, type=parse_size,
+                        default=0)
+    parser.add_argument("--bandwidth-window", help=bandwidth_window_help,
+                        type=parse_window, action="append", default=[],
+                        metavar="WINDOW")
+    parser.add_argument("--metrics", help=metrics_help)
+    parser.add_argument("--profile", help=profile_help)
     parser.add_argument("-l", "--log-level", help=loglevel_help,
                         choices=loglevel_choices,
                         default=loglevel_default)
     args = parser.parse_args()
+    accounts = None
+    if args.config:
+        (args, accounts) = load_config(parser, argv[1:])
 
     # assuming loglevel is bound to the string value obtained from the
     # command line argument. Convert to upper case to allow the user to
@@ -476,31 +3696,24 @@ def main(argv):
     numeric_level = getattr(logging, args.log_level.upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
-    logging.basicConfig(level=numeric_level)
-    logging.debug("Working dir: {dir}".format(dir=os.path.abspath(args.working_dir)))
-    logging.debug("Client secrets: {secrets}".format(secrets=args.client_secrets))
-    logging.debug("Lock file: {f}".format(f=lockfile))
-    os.chdir(os.path.abspath(args.working_dir))
-    lock = LockFile(lockfile)
-    with lock:
-        logging.debug("Lock file acquired: {f}".format(f=lock.path))
-        if args.convert == "opendocument":
-            conv = opendocument_conv
-        elif args.convert == "pdf":
-            conv = pdf_conv
+    if args.jobs > 1 or accounts:
+        logging.basicConfig(level=numeric_level,
+                            format="%(levelname)s:%(threadName)s:%(message)s")
+    else:
+        logging.basicConfig(level=numeric_level)
+    sampler = None
+    if args.profile:
+        sampler = Sampler(os.path.abspath(args.profile))
+    try:
+        if accounts:
+            sync_accounts(args, accounts)
         else:
-            print("Unknown conversion option: {c}".format(c=args.convert))
-        drive_service = Drive(client_secrets=os.path.abspath(args.client_secrets),
-                              conversion=conv)
-        logging.info("Authorizing...")
-        drive_service.authorize()
-        logging.info("Retrieving the file list...")
-        drive_service.get_filelist()
-        logging.info("Cleaning up the local tree...")
-        drive_service.clean_local_tree()
-        logging.info("Downloading the files...")
-        drive_service.download_all()
-    os.chdir(working_dir_default)
+            sync_working_dir(args)
+        logging.info("Peak memory usage: {m:.1f} MiB".format(
+                m=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    finally:
+        if sampler is not None:
+            sampler.close()
 
 if __name__ == '__main__':
     main(sys.argv)